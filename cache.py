@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    In-memory LRU cache with time to live for entries
+    thread safe, the least recently used entry is evicted when max_size is reached
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        get value by key
+        :param key: key of the entry
+        :return: value or None if there is no entry or it is expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        add or replace an entry
+        :param key: key of the entry
+        :param value: value to store
+        :param ttl: seconds to keep the entry, self.ttl if not provided or bigger
+        :return: None
+        """
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        """
+        remove an entry if it exists
+        :param key: key of the entry
+        :return: None
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        remove all entries
+        :return: None
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        cache metrics
+        :return: dict with size, hits, misses, evictions and hit ratio
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._data),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': self.hits / total if total else 0.0}
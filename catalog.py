@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import NamedTuple, Optional
+
+from cache import TTLCache
+from timing import span
+
+CATALOG_CHECK_INTERVAL = 1  # seconds between checks of the catalog version in the db
+CATALOG_RESPONSE_CACHE_SIZE = 256  # encoded responses kept, old versions are evicted first
+CATALOG_RESPONSE_TTL = 3600
+GZIP_MIN_SIZE = 512  # smaller responses are not compressed
+GZIP_LEVEL = 6
+PRICE_PREFIX_STEP = 256  # products by price rank between saved prefix bitmaps of the price index
+
+
+class Encoded(NamedTuple):
+    """
+    response content encoded once and served many times
+    """
+    body: bytes
+    gzipped: Optional[bytes]
+    etag: str
+
+    @property
+    def gzipped_etag(self):
+        """
+        etag of the gzipped body, a representation with other bytes needs its own etag
+        :return: str, the etag with -gz suffix
+        """
+        return f'{self.etag[:-1]}-gz"'
+
+
+def encode(content):
+    """
+    serialize content to json like JSONResponse does, compress it and make its etag
+    :param content: json serializable object
+    :return: Encoded
+    """
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+    gzipped = gzip.compress(body, GZIP_LEVEL, mtime=0) if len(body) >= GZIP_MIN_SIZE else None
+    return Encoded(body, gzipped, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+
+
+class CatalogIndex:
+    """
+    In-memory indexes over all products, built once per catalog version
+    products are kept in id order, every index refers to positions in this order:
+    type - hash {type: bitmap of positions}, discount - bitmap of positions,
+    price - sorted prices with their positions for bisect range search
+    bitmaps are python ints, bit i is set for the product on position i
+    """
+    def __init__(self, products: list, version: int = None):
+        self.version = version
+        self.products = sorted(products, key=lambda product: product['id'])
+        self.ids = [product['id'] for product in self.products]
+        self.all = (1 << len(self.products)) - 1
+        self.by_type = {}
+        self.discount = 0
+        for position, product in enumerate(self.products):
+            bit = 1 << position
+            self.by_type[product['type']] = self.by_type.get(product['type'], 0) | bit
+            if product['discount_check']:
+                self.discount |= bit
+        by_price = sorted((product['price'], position) for position, product in enumerate(self.products)
+                          if product['price'] is not None)
+        self.prices = [price for price, position in by_price]
+        self.price_positions = [position for price, position in by_price]
+        # price_prefixes[i] - bitmap of the i * PRICE_PREFIX_STEP cheapest products
+        self.price_prefixes = []
+        bits = bytearray(len(self.products) // 8 + 1)
+        for rank, position in enumerate(self.price_positions):
+            if rank % PRICE_PREFIX_STEP == 0:
+                self.price_prefixes.append(int.from_bytes(bits, 'little'))
+            bits[position >> 3] |= 1 << (position & 7)
+        if len(self.price_positions) % PRICE_PREFIX_STEP == 0:
+            self.price_prefixes.append(int.from_bytes(bits, 'little'))
+
+    def page(self, after_id: int = 0, limit: int = None):
+        """
+        products ordered by id, keyset pagination
+        :param after_id: return products with bigger ids only
+        :param limit: max number of products to return
+        :return: list of product dicts
+        """
+        start = bisect_right(self.ids, after_id)
+        return self.products[start:None if limit is None else start + limit]
+
+    def _price_prefix(self, rank: int):
+        """
+        bitmap of products with price rank less than the given one,
+        the saved prefix plus less than PRICE_PREFIX_STEP bits set in bytes and converted to int once
+        :param rank: number of the cheapest products
+        :return: int bitmap
+        """
+        step = rank // PRICE_PREFIX_STEP
+        bits = bytearray(len(self.products) // 8 + 1)
+        for position in self.price_positions[step * PRICE_PREFIX_STEP:rank]:
+            bits[position >> 3] |= 1 << (position & 7)
+        return self.price_prefixes[step] | int.from_bytes(bits, 'little')
+
+    def _price_bitmap(self, price_min: int = None, price_max: int = None):
+        """
+        bitmap of products with price in range, bounds are included
+        :return: int bitmap
+        """
+        start = 0 if price_min is None else bisect_left(self.prices, price_min)
+        end = len(self.prices) if price_max is None else bisect_right(self.prices, price_max)
+        if start >= end:
+            return 0
+        # the cheaper products are in both prefixes
+        return self._price_prefix(end) ^ self._price_prefix(start)
+
+    def query(self, type_: str = None, price_min: int = None, price_max: int = None,
+              discount: bool = None, after_id: int = 0, limit: int = None):
+        """
+        find products by filters, all provided filters should match
+        :param type_: type of products
+        :param price_min: min price, included
+        :param price_max: max price, included
+        :param discount: True - only with discount, False - only without
+        :param after_id: return products with bigger ids only, for pagination
+        :param limit: max number of products to return
+        :return: list of product dicts ordered by id
+        """
+        bitmap = self.all
+        if type_ is not None:
+            bitmap &= self.by_type.get(type_, 0)
+        if discount is not None:
+            bitmap &= self.discount if discount else ~self.discount
+        if price_min is not None or price_max is not None:
+            bitmap &= self._price_bitmap(price_min, price_max)
+        # drop positions up to after_id
+        offset = bisect_right(self.ids, after_id)
+        bitmap >>= offset
+        result = []
+        while bitmap and (limit is None or len(result) < limit):
+            lowest = bitmap & -bitmap
+            result.append(self.products[offset + lowest.bit_length() - 1])
+            bitmap ^= lowest
+        return result
+
+
+class Catalog:
+    """
+    Holder of the current CatalogIndex
+    the index is rebuilt when the catalog version in the db changes (checked every
+    CATALOG_CHECK_INTERVAL seconds) or right after invalidate() in this process
+    """
+    def __init__(self, load, version, check_interval: float = CATALOG_CHECK_INTERVAL):
+        """
+        :param load: function returning iterable of all product dicts
+        :param version: function returning the current catalog version from the db
+        :param check_interval: seconds between version checks
+        """
+        self.load = load
+        self.version = version
+        self.check_interval = check_interval
+        self._index = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.responses = TTLCache(CATALOG_RESPONSE_CACHE_SIZE, CATALOG_RESPONSE_TTL)
+
+    def invalidate(self):
+        """
+        make the next get() check the version
+        :return: None
+        """
+        self._checked = 0.0
+
+    def get(self):
+        """
+        current index, rebuilt if the catalog has changed
+        :return: CatalogIndex
+        """
+        index = self._index
+        if index is not None and time.monotonic() - self._checked < self.check_interval:
+            return index
+        with self._lock:
+            index = self._index
+            if index is not None and time.monotonic() - self._checked < self.check_interval:
+                return index
+            version = self.version()
+            if index is None or index.version != version:
+                index = CatalogIndex(list(self.load()), version)
+                self._index = index
+            self._checked = time.monotonic()
+            return index
+
+    def response(self, key, render):
+        """
+        encoded response for the current catalog version, rendered only once per version and key
+        :param key: hashable key of the response, for example the query parameters
+        :param render: function (CatalogIndex) -> json serializable content
+        :return: Encoded
+        """
+        index = self.get()
+        entry = self.responses.get((index.version, key))
+        if entry is None:
+            with span('render'):
+                entry = encode(render(index))
+            self.responses.set((index.version, key), entry)
+        return entry
@@ -1,110 +1,666 @@
+import asyncio
+import contextvars
+import json
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from functools import lru_cache, partial
 
-DATABASE_FILE = 'db.db'
+import settings
+from timing import span, timed
+
+DATABASE_FILE = settings.DATABASE_FILE
+POOL_MAX_SIZE = 8
+POOL_TIMEOUT = 5  # seconds to wait for a free connection
+POOL_LIFETIME = 600  # seconds before a connection is reopened
+POOL_PING_INTERVAL = 30  # idle seconds before a connection is checked
+STATEMENT_CACHE_SIZE = 256  # sql texts memoized and compiled statements kept per connection
+BULK_BATCH_SIZE = 500  # rows sent to one executemany call
+ITER_CHUNK_SIZE = 500  # rows fetched at once by iter_select
+FTS_MAX_TERMS = 8  # words of a search text used in a full-text query
+WRITER_BATCH_WINDOW = 0.002  # seconds to gather pending writes into one transaction
+WRITER_BATCH_SIZE = 200  # max writes in one transaction
+WRITER_TIMEOUT = 30  # seconds to wait for a write to be committed
+
+# pragmas applied to every connection, WAL lets readers work while a write is in progress
+STORAGE_PROFILES = {
+    # every commit is synced to disk
+    'durable': {'journal_mode': 'wal',
+                'synchronous': 'full',
+                'mmap_size': 0,
+                'cache_size': -16000,  # KiB
+                'temp_store': 'default',
+                'busy_timeout': 5000},  # ms
+    # WAL is synced on checkpoints only, last commits can be lost on power failure, not on app crash
+    'fast': {'journal_mode': 'wal',
+             'synchronous': 'normal',
+             'mmap_size': 268435456,
+             'cache_size': -64000,
+             'temp_store': 'memory',
+             'busy_timeout': 5000},
+}
+
+
+def storage_pragmas(profile: str, overrides: dict = None):
+    """
+    form pragmas of a storage profile
+    :param profile: name of a preset in STORAGE_PROFILES
+    :param overrides: dict {pragma: value} to replace values of the preset
+    :return: dict {pragma: value}
+    """
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f'unknown storage profile {profile}, use one of {", ".join(STORAGE_PROFILES)}')
+    pragmas = {**STORAGE_PROFILES[profile], **(overrides or {})}
+    for pragma, value in pragmas.items():
+        # pragma values can not be passed as parameters, so they are checked
+        if not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError(f'wrong value {value} of pragma {pragma}')
+    return pragmas
+
+
+STORAGE = storage_pragmas(settings.STORAGE_PROFILE, settings.STORAGE_OVERRIDES)
+
+
+def connect(database: str, pragmas: dict, **kwargs):
+    """
+    open new connection to the database and apply storage pragmas
+    :param database: path to the db file
+    :param pragmas: dict {pragma: value}
+    :param kwargs: other arguments of sqlite3.connect
+    :return: sqlite3 connection
+    """
+    connection = sqlite3.connect(database, check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    try:
+        for pragma, value in pragmas.items():
+            connection.execute(f'pragma {pragma} = {value}').fetchall()
+    except sqlite3.Error:
+        connection.close()
+        raise
+    return connection
+
+
+class PoolTimeout(Exception):
+    """
+    raised when no connection is free in the pool in time
+    """
+
+
+class WriterTimeout(sqlite3.OperationalError):
+    """
+    raised when a write is not committed in time, it is a sqlite3.OperationalError
+    like "database is locked", so callers handle both the same way
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded pool of long-lived sqlite3 connections
+    connections are checked out for one operation and checked in back warm,
+    so the page cache is kept between requests
+    """
+    def __init__(self, database: str = DATABASE_FILE, max_size: int = POOL_MAX_SIZE,
+                 timeout: float = POOL_TIMEOUT, lifetime: float = POOL_LIFETIME,
+                 ping_interval: float = POOL_PING_INTERVAL, pragmas: dict = None):
+        self.database = database
+        self.pragmas = STORAGE if pragmas is None else pragmas
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.ping_interval = ping_interval
+        self._idle = queue.LifoQueue()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        open new connection to the database and apply storage pragmas
+        :return: tuple (connection, created time)
+        """
+        return connect(self.database, self.pragmas), time.monotonic()
+
+    def _discard(self, connection):
+        """
+        close connection and free its place in the pool
+        :param connection: connection to close
+        :return: None
+        """
+        with self._lock:
+            self._size -= 1
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_healthy(self, connection, created: float, released: float):
+        """
+        check if idle connection can be reused
+        :return: bool
+        """
+        now = time.monotonic()
+        if now - created > self.lifetime:
+            return False
+        if now - released > self.ping_interval:
+            try:
+                connection.execute('select 1').fetchone()
+            except sqlite3.Error:
+                return False
+        return True
+
+    def checkout(self):
+        """
+        take a connection from the pool, open a new one if the pool is not full
+        :return: tuple (connection, created time)
+        """
+        while True:
+            try:
+                connection, created, released = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_open = self._size < self.max_size
+                    if can_open:
+                        self._size += 1
+                if can_open:
+                    try:
+                        return self._connect()
+                    except sqlite3.Error:
+                        with self._lock:
+                            self._size -= 1
+                        raise
+                try:
+                    connection, created, released = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(f'no free connection in {self.timeout} seconds')
+            if self._is_healthy(connection, created, released):
+                return connection, created
+            self._discard(connection)
+
+    def checkin(self, connection, created: float, suspect: bool = False):
+        """
+        return a connection to the pool
+        :param connection: connection taken by checkout()
+        :param created: created time returned by checkout()
+        :param suspect: True if an error happened, the connection is checked before reuse
+        :return: None
+        """
+        if connection.in_transaction:
+            try:
+                connection.rollback()
+            except sqlite3.Error:
+                self._discard(connection)
+                return
+        released = float('-inf') if suspect else time.monotonic()
+        self._idle.put((connection, created, released))
+
+    @contextmanager
+    def connection(self):
+        """
+        context manager to check out a connection and check it in after use
+        :return: sqlite3 connection
+        """
+        connection, created = self.checkout()
+        try:
+            yield connection
+        except sqlite3.Error:
+            self.checkin(connection, created, suspect=True)
+            raise
+        except BaseException:
+            self.checkin(connection, created)
+            raise
+        self.checkin(connection, created)
+
+    def close(self):
+        """
+        close all idle connections
+        :return: None
+        """
+        while True:
+            try:
+                connection, created, released = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+
+# schema changes, applied once in order, the number of applied ones is kept in pragma user_version
+MIGRATIONS = [
+    # 1: session expiry as indexed epoch seconds (600 - session lifetime at the time)
+    ["alter table session add column expires INTEGER",
+     "update session set expires = 600 + case typeof(last_activity) when 'integer' then last_activity "
+     "else cast(strftime('%s', replace(last_activity, ',', ''), 'utc') as integer) end",
+     "create index if not exists session_expires on session (expires)"],
+    # 2: catalog version, changed by any write to product, to know when caches of products are stale
+    ["create table if not exists meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+     "insert or ignore into meta (key, value) values ('product_version', 0)",
+     "create trigger if not exists product_version_insert after insert on product begin "
+     "update meta set value = value + 1 where key = 'product_version'; end",
+     "create trigger if not exists product_version_update after update on product begin "
+     "update meta set value = value + 1 where key = 'product_version'; end",
+     "create trigger if not exists product_version_delete after delete on product begin "
+     "update meta set value = value + 1 where key = 'product_version'; end"],
+    # 3: full-text index of products by name and type, content is read from the product table
+    ["create virtual table if not exists product_fts using fts5(name, type, content='product', "
+     "content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+     "insert into product_fts (product_fts) values ('rebuild')",
+     "create trigger if not exists product_fts_insert after insert on product begin "
+     "insert into product_fts (rowid, name, type) values (new.id, new.name, new.type); end",
+     "create trigger if not exists product_fts_delete after delete on product begin "
+     "insert into product_fts (product_fts, rowid, name, type) "
+     "values ('delete', old.id, old.name, old.type); end",
+     "create trigger if not exists product_fts_update after update on product begin "
+     "insert into product_fts (product_fts, rowid, name, type) "
+     "values ('delete', old.id, old.name, old.type); "
+     "insert into product_fts (rowid, name, type) values (new.id, new.name, new.type); end"],
+]
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def row_type(columns: tuple):
+    """
+    class of named rows with the given columns, one class for every set of columns
+    rows are tuples with attrs by column names, without a dict per row
+    :param columns: names of columns
+    :return: namedtuple class
+    """
+    return namedtuple('Row', columns, rename=True)
+
+
+def name_rows(cursor: sqlite3.Cursor):
+    """
+    make the executed cursor return named rows, see row_type
+    :param cursor: cursor after execute
+    :return: the cursor
+    """
+    if cursor.description is not None:
+        make = row_type(tuple(column[0] for column in cursor.description))._make
+        cursor.row_factory = lambda cursor, row: make(row)
+    return cursor
+
+
+def fts_match(text: str):
+    """
+    make fts5 match expression from a user search text,
+    every word is quoted and used as a prefix, all words should match
+    :param text: search text, for example "роза ал"
+    :return: str expression, empty if there are no words in the text
+    """
+    words = re.findall(r'\w+', text.lower())[:FTS_MAX_TERMS]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def migrate(database: str = DATABASE_FILE):
+    """
+    bring the db schema to the last version
+    safe to run from several processes at once
+    :param database: path to the db file
+    :return: number of applied migrations
+    """
+    connection = sqlite3.connect(database, isolation_level=None)
+    applied = 0
+    try:
+        while True:
+            connection.execute('begin immediate')
+            version = connection.execute('pragma user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                connection.execute('rollback')
+                return applied
+            try:
+                for statement in MIGRATIONS[version]:
+                    connection.execute(statement)
+                connection.execute(f'pragma user_version = {version + 1}')
+            except sqlite3.Error:
+                connection.execute('rollback')
+                raise
+            connection.execute('commit')
+            applied += 1
+    finally:
+        connection.close()
+
+
+class Writer:
+    """
+    Single thread that does all writes to the database with its own connection
+    pending writes are grouped into one transaction (group commit),
+    every write is isolated by a savepoint, so a failed one does not affect others
+    """
+    def __init__(self, database: str = DATABASE_FILE, pragmas: dict = None,
+                 window: float = WRITER_BATCH_WINDOW, batch_size: int = WRITER_BATCH_SIZE,
+                 timeout: float = WRITER_TIMEOUT):
+        self.database = database
+        self.pragmas = STORAGE if pragmas is None else pragmas
+        self.window = window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, work):
+        """
+        queue write work, the writer thread is started on the first call
+        and started again if it has exited
+        :param work: function (connection) -> result, runs inside a transaction
+        :return: concurrent.futures.Future, resolved after commit
+        """
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='database-writer', daemon=True)
+                self._thread.start()
+            self._queue.put((work, future))
+        return future
+
+    def stop(self):
+        """
+        commit queued writes and stop the writer thread
+        :return: None
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join()
+
+    def _run(self):
+        """
+        writer thread loop
+        whatever the way the thread exits, writes left in the queue are failed
+        and the next submit() starts a new thread with a new connection
+        :return: None
+        """
+        error = sqlite3.OperationalError('database writer is stopped')
+        connection = None
+        try:
+            connection = connect(self.database, self.pragmas, isolation_level=None)
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                jobs = self._collect(job)
+                try:
+                    self._commit(connection, jobs)
+                except Exception as e:
+                    # the connection failed itself, not a single write
+                    self._fail(jobs, e)
+                    if connection.in_transaction:
+                        connection.rollback()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                self._thread = None
+                # submit() puts under the lock, so nothing is queued for this thread after that
+                while True:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is not None:
+                        self._fail([job], error)
+            if connection is not None:
+                connection.close()
+
+    @staticmethod
+    def _fail(jobs: list, error: Exception):
+        """
+        resolve futures of not finished writes with an error
+        :param jobs: list of tuples (work, future)
+        :param error: exception to set
+        :return: None
+        """
+        for work, future in jobs:
+            if not future.done():
+                future.set_exception(error)
+
+    def _collect(self, job):
+        """
+        gather writes coming during the batch window
+        :param job: first pending write
+        :return: list of tuples (work, future)
+        """
+        jobs = [job]
+        deadline = time.monotonic() + self.window
+        while len(jobs) < self.batch_size:
+            try:
+                job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if job is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _commit(self, connection, jobs: list):
+        """
+        run writes in one transaction and resolve their futures
+        :param connection: connection of the writer
+        :param jobs: list of tuples (work, future)
+        :return: None
+        """
+        try:
+            connection.execute('begin immediate')
+        except sqlite3.Error as e:
+            self._fail(jobs, e)
+            return
+        results = []
+        for work, future in jobs:
+            if not future.set_running_or_notify_cancel():
+                continue
+            connection.execute('savepoint write')
+            try:
+                result = work(connection)
+            except Exception as e:
+                connection.execute('rollback to write')
+                results.append((future, None, e))
+            else:
+                results.append((future, result, None))
+            connection.execute('release write')
+        try:
+            connection.execute('commit')
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute('rollback')
+            for future, result, error in results:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+POOL = ConnectionPool()
+WRITER = Writer()
+EXECUTOR = ThreadPoolExecutor(max_workers=POOL_MAX_SIZE, thread_name_prefix='database')
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    run blocking database work in the database executor,
+    so the event loop is free while sqlite works
+    the work sees context variables of the caller, so its spans are reported to the request
+    :param func: function to run
+    :return: result of the function
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(EXECUTOR, partial(context.run, func, *args, **kwargs))
 
 
 class DataBase:
     """
     Class to connect to a database
-    uses sqlite3
+    uses sqlite3, reads take connections from a pool, writes are done by the writer thread
     """
-    def __init__(self):
-        self.connection = sqlite3.connect(DATABASE_FILE)
-        self.cursor = self.connection.cursor()
+    def __init__(self, pool: ConnectionPool = None, writer: 'Writer' = None):
+        self.pool = pool or POOL
+        self.writer = writer or WRITER
+
+    def _write(self, work):
+        """
+        run write work in the writer thread and wait for it to be committed
+        :param work: function (connection) -> result, runs inside a transaction
+        :return: result of the work
+        """
+        future = self.writer.submit(work)
+        try:
+            return future.result(self.writer.timeout)
+        except FutureTimeout:
+            # a write that has not started yet is dropped, a running one may still be committed
+            future.cancel()
+            raise WriterTimeout(f'write is not committed in {self.writer.timeout} seconds') from None
 
     @staticmethod
-    def _form_db_format(list_: list):
+    def _form_db_format(list_):
         """
         method to form list ['el', 'el', 'el']
         to a form for database requests (el, el, el)
         :param list_: a list to reformat
         :return: str injection in format (el, el, el)
         """
-        result = f'({list_[0]},'
-        if len(list_) > 2:
-            for el in list_[1:-1]:
-                result += f' {el},'
-        if len(list_) > 1:
-            result += f' {list_[-1]})'
-        else:
-            result += ' )'
-        return result
-
-    def _form_inject_format(self, dict_):
-        """
-        method to form injections in requests
-        :param dict_: a dict of values to insert to a db
-                      in format {column name: value to insert}
-        :return: keys in str format (el, el, el), values in tuple,
-                 proxies in str format (?, ?, ?)
-        """
-        values = []
-        keys = list(dict_.keys())
-        proxies = []
-        for key in keys:
-            values.append(dict_[key])
-            proxies.append('?')
-        values = tuple(values)
-        proxies = self._form_db_format(proxies)
-        keys = self._form_db_format(keys)
-        return keys, values, proxies
+        return f"({', '.join(list_)})"
 
     @staticmethod
-    def _form_set(dict_):
+    def _form_set(keys):
         """
         method to form set condition injections in requests
-        :param dict_: provided conditions in dict
-        :return: condition - to inject in request,
-                 values - to send as an argument for a cursor.execute()
-        """
-        condition = ""
-        values = []
-        keys = list(dict_.keys())
-        if len(keys) > 1:
-            for key in keys[:-1]:
-                condition += f'{key} = ?, '
-                values.append(dict_[key])
-        condition += f'{keys[-1]} = ?'
-        values.append(dict_[keys[-1]])
-        values = tuple(values)
-        return condition, values
+        :param keys: names of columns to set
+        :return: condition - to inject in request
+        """
+        return ', '.join(f'{key} = ?' for key in keys)
 
     @staticmethod
-    def _form_where(dict_):
+    def _form_where(keys):
         """
         method to form where condition injections in requests
-        :param dict_: provided conditions in dict
-        :return: condition - to inject in request,
-                 values - to send as an argument for a cursor.execute()
-        """
-        condition = "where "
-        values = []
-        keys = list(dict_.keys())
-        if len(keys) > 1:
-            for key in keys[:-1]:
-                condition += f'{key} = ? and '
-                values.append(dict_[key])
-        condition += f'{keys[-1]} = ?'
-        values.append(dict_[keys[-1]])
-        values = tuple(values)
-        return condition, values
+        :param keys: names of columns in conditions
+        :return: condition - to inject in request
+        """
+        return 'where ' + ' and '.join(f'{key} = ?' for key in keys)
+
+    @staticmethod
+    @lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+    def _statement(operation: str, table_name: str, columns: tuple = (), conditions: tuple = (),
+                   order_by: str = None):
+        """
+        build sql text of a request, memoized by the request shape,
+        the same text lets sqlite reuse the compiled statement from the connection cache
+        :param operation: insert, select, update, upsert or delete
+        :param table_name: name of the table in db
+        :param columns: names of columns to insert, set or select (all if empty)
+        :param conditions: names of columns in where condition,
+                           for upsert - names of unique columns
+        :param order_by: order of selected records, for example 'id' or 'price desc'
+        :return: str sql
+        """
+        if operation == 'insert':
+            proxies = DataBase._form_db_format('?' * len(columns))
+            return f"insert into {table_name} {DataBase._form_db_format(columns)} values {proxies}"
+        where = f" {DataBase._form_where(conditions)}" if conditions else ''
+        if operation == 'select':
+            search = ', '.join(columns) if columns else '*'
+            order = f" order by {order_by}" if order_by else ''
+            return f"select {search} from {table_name}{where}{order}"
+        if operation == 'update':
+            return f"update {table_name} set {DataBase._form_set(columns)}{where}"
+        if operation == 'upsert':
+            insert = DataBase._statement('insert', table_name, columns)
+            update = ', '.join(f'{column} = excluded.{column}' for column in columns
+                               if column not in conditions)
+            # when every column is a key there is nothing to update, existing records are kept
+            action = f"do update set {update}" if update else "do nothing"
+            return f"{insert} on conflict {DataBase._form_db_format(conditions)} {action}"
+        if operation == 'delete':
+            return f"delete from {table_name}{where}"
+        raise ValueError(f'unknown operation {operation}')
 
+    @timed('db')
     def insert(self, table_name: str, values: dict):
         """
         insert request to a database
         :param table_name: name of the table in db to search in
         :param values: a dict of values to insert to a
                        db in format {column name: value to insert}
-        :return: None
+        :return: id (rowid) of the inserted record
+        """
+        statement = self._statement('insert', table_name, tuple(values))
+
+        def work(connection):
+            return connection.execute(statement, tuple(values.values())).lastrowid
+        return self._write(work)
+
+    @staticmethod
+    def _batches(rows: list, batch_size: int):
         """
-        with self.connection:
-            values_dict = self._form_inject_format(values)
-            keys = values_dict[0]
-            values = values_dict[1]
-            proxies = values_dict[2]
-            self.cursor.execute(f"insert into {table_name} {keys} values {proxies}", values)
+        split rows to batches
+        :param rows: list to split
+        :param batch_size: max length of a batch
+        :return: generator of lists
+        """
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    @timed('db')
+    def insert_many(self, table_name: str, values: list, batch_size: int = BULK_BATCH_SIZE):
+        """
+        insert many records in one transaction with executemany
+        :param table_name: name of the table in db to insert to
+        :param values: list of dicts {column name: value}, all with the same columns
+        :param batch_size: max number of records in one executemany call
+        :return: list of ids of inserted records, in order of values,
+                 records should not have explicit ids
+        """
+        if not values:
+            return []
+        columns = tuple(values[0])
+        statement = self._statement('insert', table_name, columns)
+
+        def work(connection):
+            for batch in self._batches(values, batch_size):
+                connection.executemany(statement, [tuple(row[column] for column in columns)
+                                                   for row in batch])
+            # the table is locked by the transaction, so new ids go one by one
+            return connection.execute('select last_insert_rowid()').fetchone()[0]
+        last_id = self._write(work)
+        return list(range(last_id - len(values) + 1, last_id + 1))
+
+    @timed('db')
+    def upsert_many(self, table_name: str, values: list, keys: tuple,
+                    batch_size: int = BULK_BATCH_SIZE):
+        """
+        insert many records or update existing ones in one transaction with executemany
+        :param table_name: name of the table in db
+        :param values: list of dicts {column name: value}, all with the same columns
+        :param keys: names of unique columns to find existing records by
+        :param batch_size: max number of records in one executemany call
+        :return: number of inserted and updated records, only inserted if all columns are keys
+        """
+        if not values:
+            return 0
+        columns = tuple(values[0])
+        statement = self._statement('upsert', table_name, columns, tuple(keys))
+
+        def work(connection):
+            count = 0
+            for batch in self._batches(values, batch_size):
+                count += connection.executemany(statement, [tuple(row[column] for column in columns)
+                                                            for row in batch]).rowcount
+            return count
+        return self._write(work)
 
-    def select(self, table_name: str, search: list = None, conditions: dict = None):
+    @timed('db')
+    def select(self, table_name: str, search: list = None, conditions: dict = None,
+               order_by: str = None, named: bool = False):
         """
         select request to a database
         :param table_name: name of the table in db to search in
@@ -112,23 +668,77 @@ class DataBase:
                        if not provided return all columns of the table
         :param conditions: dict of condition values to inject in request, if not provided
                            return all records of the table
+        :param order_by: order of records, for example 'id' or 'price desc'
+        :param named: True to return named rows with attrs by column names, see row_type
         :return: tuple of search results
         """
-        with self.connection:
-            if search is not None:
-                search = ', '.join(search)
-            else:
-                search = '*'
-            if conditions is not None:
-                conditions = self._form_where(conditions)
-                condition = conditions[0]
-                values = conditions[1]
-                result = self.cursor.execute(f"select {search} from {table_name} {condition}",
-                                             values).fetchall()
-            else:
-                result = self.cursor.execute(f"select {search} from {table_name}").fetchall()
-            return result
+        conditions = conditions or {}
+        statement = self._statement('select', table_name, tuple(search or ()), tuple(conditions), order_by)
+        values = tuple(conditions.values())
+        with self.pool.connection() as connection, connection:
+            cursor = connection.execute(statement, values)
+            if named:
+                name_rows(cursor)
+            return cursor.fetchall()
 
+    @timed('db')
+    def search(self, table_name: str, fts_table: str, match: str, search: list = None,
+               weights: tuple = (), limit: int = None, offset: int = 0, named: bool = False):
+        """
+        full-text search request, records are ranked by bm25, the best first
+        :param table_name: name of the table with the content of the fts table
+        :param fts_table: name of the fts5 table over table_name, its rowid is table_name.id
+        :param match: fts5 match expression, see fts_match
+        :param search: list of column's names in table_name to return in result, all if not provided
+        :param weights: bm25 weights of the fts columns, for example (10.0, 1.0)
+        :param limit: max number of records to return
+        :param offset: number of the best records to skip, for pagination
+        :param named: True to return named rows, see row_type
+        :return: tuple of search results
+        """
+        columns = ', '.join(f'{table_name}.{column}' for column in search) if search else f'{table_name}.*'
+        rank = ', '.join(['bm25(' + fts_table] + [str(float(weight)) for weight in weights]) + ')'
+        statement = (f"select {columns} from {fts_table} join {table_name} on {table_name}.id = {fts_table}.rowid "
+                     f"where {fts_table} match ? order by {rank}, {table_name}.id limit ? offset ?")
+        with self.pool.connection() as connection, connection:
+            cursor = connection.execute(statement, (match, -1 if limit is None else limit, offset))
+            if named:
+                name_rows(cursor)
+            return cursor.fetchall()
+
+    def iter_select(self, table_name: str, search: list = None, conditions: dict = None,
+                    order_by: str = None, chunk_size: int = ITER_CHUNK_SIZE, named: bool = False):
+        """
+        select request to a database, records are fetched by chunks while iterating,
+        so memory does not depend on the number of records
+        a pooled connection is held until the generator is exhausted or closed
+        :param table_name: name of the table in db to search in
+        :param search: list of column's names in table to return in result,
+                       if not provided return all columns of the table
+        :param conditions: dict of condition values to inject in request, see select
+        :param order_by: order of records
+        :param chunk_size: number of records fetched at once
+        :param named: True to return named rows, see row_type
+        :return: generator of records
+        """
+        conditions = conditions or {}
+        statement = self._statement('select', table_name, tuple(search or ()), tuple(conditions),
+                                    order_by)
+        with self.pool.connection() as connection:
+            cursor = connection.execute(statement, tuple(conditions.values()))
+            if named:
+                name_rows(cursor)
+            try:
+                while True:
+                    with span('db'):
+                        rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        return
+                    yield from rows
+            finally:
+                cursor.close()
+
+    @timed('db')
     def delete(self, table_name: str, conditions: dict):
         """
         delete request to a database
@@ -136,12 +746,59 @@ class DataBase:
         :param conditions: dict of condition values to inject in request
         :return: None
         """
-        with self.connection:
-            conditions = self._form_where(conditions)
-            condition = conditions[0]
-            values = conditions[1]
-            self.cursor.execute(f"delete from {table_name} {condition}", values)
+        statement = self._statement('delete', table_name, conditions=tuple(conditions))
+
+        def work(connection):
+            connection.execute(statement, tuple(conditions.values()))
+        self._write(work)
+
+    @timed('db')
+    def delete_below(self, table_name: str, column: str, value, limit: int, keep: list = ()):
+        """
+        delete a batch of records with column value less than the given one,
+        the column should be indexed
+        :param table_name: name of the table in db to delete from
+        :param column: name of the column to compare
+        :param value: records with smaller values are deleted
+        :param limit: max number of records to delete
+        :param keep: ids of records not to delete, passed as one json parameter
+        :return: number of deleted records
+        """
+        statement = (f"delete from {table_name} where rowid in "
+                     f"(select rowid from {table_name} where {column} < ? "
+                     f"and rowid not in (select value from json_each(?)) limit ?)")
+        keep = json.dumps(list(keep))
+
+        def work(connection):
+            return connection.execute(statement, (value, keep, limit)).rowcount
+        return self._write(work)
+
+    @timed('db')
+    def update_many(self, table_name: str, values: list, key: str,
+                    batch_size: int = BULK_BATCH_SIZE):
+        """
+        update many records in one transaction with executemany
+        :param table_name: name of the table in db to update
+        :param values: list of dicts {column name: value}, all with the same columns,
+                       including the key column
+        :param key: name of the column to find records by
+        :param batch_size: max number of records in one executemany call
+        :return: number of updated records
+        """
+        if not values:
+            return 0
+        columns = tuple(column for column in values[0] if column != key)
+        statement = self._statement('update', table_name, columns, (key,))
 
+        def work(connection):
+            count = 0
+            for batch in self._batches(values, batch_size):
+                count += connection.executemany(statement, [tuple(row[column] for column in columns) +
+                                                            (row[key],) for row in batch]).rowcount
+            return count
+        return self._write(work)
+
+    @timed('db')
     def update(self, table_name: str, values: dict, conditions: dict):
         """
         update request to a database
@@ -151,12 +808,105 @@ class DataBase:
         :param conditions: dict of condition values to inject in request
         :return: None
         """
-        with self.connection:
-            values_dict = self._form_set(values)
-            values_condition = values_dict[0]
-            inject_values = values_dict[1]
-            conditions = self._form_where(conditions)
-            condition = conditions[0]
-            condition_values = conditions[1]
-            values = inject_values + condition_values
-            self.cursor.execute(f"update {table_name} set {values_condition} {condition}", values)
+        statement = self._statement('update', table_name, tuple(values), tuple(conditions))
+
+        def work(connection):
+            connection.execute(statement, tuple(values.values()) + tuple(conditions.values()))
+        self._write(work)
+
+    @timed('db')
+    def write_many(self, operations: list):
+        """
+        several insert and update requests in one transaction, all or nothing
+        :param operations: list of ('insert', table name, values) and
+                           ('update', table name, values, conditions) tuples, see insert and update
+        :return: list of results in the same order: id of the inserted record or number of updated ones
+        """
+        requests = []
+        for operation, table_name, values, *conditions in operations:
+            conditions = conditions[0] if conditions else {}
+            statement = self._statement(operation, table_name, tuple(values), tuple(conditions))
+            requests.append((operation, statement, tuple(values.values()) + tuple(conditions.values())))
+
+        def work(connection):
+            results = []
+            for operation, statement, parameters in requests:
+                cursor = connection.execute(statement, parameters)
+                results.append(cursor.lastrowid if operation == 'insert' else cursor.rowcount)
+            return results
+        return self._write(work)
+
+
+class AsyncDataBase:
+    """
+    Awaitable variant of DataBase
+    requests run in the database executor
+    """
+    def __init__(self, pool: ConnectionPool = None, writer: 'Writer' = None):
+        self.database = DataBase(pool, writer)
+
+    async def insert(self, table_name: str, values: dict):
+        """
+        insert request to a database, see DataBase.insert
+        """
+        return await run_in_executor(self.database.insert, table_name, values)
+
+    async def insert_many(self, table_name: str, values: list, batch_size: int = BULK_BATCH_SIZE):
+        """
+        insert many records in one transaction, see DataBase.insert_many
+        """
+        return await run_in_executor(self.database.insert_many, table_name, values, batch_size)
+
+    async def upsert_many(self, table_name: str, values: list, keys: tuple,
+                          batch_size: int = BULK_BATCH_SIZE):
+        """
+        insert or update many records in one transaction, see DataBase.upsert_many
+        """
+        return await run_in_executor(self.database.upsert_many, table_name, values, keys, batch_size)
+
+    async def select(self, table_name: str, search: list = None, conditions: dict = None,
+                     order_by: str = None, named: bool = False):
+        """
+        select request to a database, see DataBase.select
+        """
+        return await run_in_executor(self.database.select, table_name, search, conditions,
+                                     order_by, named)
+
+    async def search(self, table_name: str, fts_table: str, match: str, search: list = None,
+                     weights: tuple = (), limit: int = None, offset: int = 0, named: bool = False):
+        """
+        full-text search request, see DataBase.search
+        """
+        return await run_in_executor(self.database.search, table_name, fts_table, match, search,
+                                     weights, limit, offset, named)
+
+    async def delete(self, table_name: str, conditions: dict):
+        """
+        delete request to a database, see DataBase.delete
+        """
+        return await run_in_executor(self.database.delete, table_name, conditions)
+
+    async def delete_below(self, table_name: str, column: str, value, limit: int, keep: list = ()):
+        """
+        delete a batch of records, see DataBase.delete_below
+        """
+        return await run_in_executor(self.database.delete_below, table_name, column, value, limit, keep)
+
+    async def update_many(self, table_name: str, values: list, key: str,
+                          batch_size: int = BULK_BATCH_SIZE):
+        """
+        update many records in one transaction, see DataBase.update_many
+        """
+        return await run_in_executor(self.database.update_many, table_name, values, key, batch_size)
+
+    async def update(self, table_name: str, values: dict, conditions: dict):
+        """
+        update request to a database, see DataBase.update
+        """
+        return await run_in_executor(self.database.update, table_name, values, conditions)
+
+    async def write_many(self, operations: list):
+        """
+        several requests in one transaction, see DataBase.write_many
+        """
+        return await run_in_executor(self.database.write_many, operations)
@@ -0,0 +1,154 @@
+import asyncio
+import base64
+import contextvars
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from timing import timed
+
+SCRYPT_N = 2 ** 14  # cpu/memory cost, 16 MiB and about 50 ms per hash with r = 8
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_WORKERS = os.cpu_count() or 1  # hashlib releases the GIL, so threads use all cores
+HASH_QUEUE_SIZE = HASH_WORKERS * 8  # hashes running or waiting, more are rejected with HashingBusy
+HASH_BULK_SIZE = max(1, HASH_WORKERS // 2)  # hashes of a bulk import in the pool at once, other workers serve logins
+LEGACY_MD5 = re.compile(r'[0-9a-f]{32}')
+
+HASH_POOL = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hashing')
+_slots = threading.BoundedSemaphore(HASH_QUEUE_SIZE)
+
+
+class HashingBusy(Exception):
+    """
+    too many passwords are being hashed, the request should be retried later
+    """
+
+
+def _b64(data: bytes):
+    """
+    base64 without padding
+    :param data: bytes to encode
+    :return: str
+    """
+    return base64.b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(data: str):
+    """
+    decode base64 without padding
+    :param data: str to decode
+    :return: bytes
+    """
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    """
+    scrypt key of the password
+    :return: 32 bytes
+    """
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * n * r * p, dklen=32)
+
+
+@timed('hash')
+def hash_password(password: str):
+    """
+    hash password with scrypt and random salt
+    blocking for tens of milliseconds, use ahash_password in async code
+    :param password: password to hash
+    :return: str in format scrypt$n$r$p$salt$hash
+    """
+    salt = secrets.token_bytes(SALT_SIZE)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}'
+
+
+@timed('hash')
+def verify(password: str, encoded: str):
+    """
+    check password against a hash made by hash_password or a legacy md5 hex digest
+    blocking, use averify in async code
+    :param password: password to check
+    :param encoded: hash from the db
+    :return: bool
+    """
+    if not password or not encoded:
+        return False
+    if LEGACY_MD5.fullmatch(encoded):
+        return hmac.compare_digest(hashlib.md5(password.encode('utf-8')).hexdigest(), encoded)
+    try:
+        algorithm, n, r, p, salt, key = encoded.split('$')
+        if algorithm != 'scrypt':
+            return False
+        return hmac.compare_digest(_scrypt(password, _unb64(salt), int(n), int(r), int(p)), _unb64(key))
+    except ValueError:
+        return False
+
+
+def needs_rehash(encoded: str):
+    """
+    check the hash is legacy md5 or made with other scrypt parameters
+    :param encoded: hash from the db
+    :return: bool
+    """
+    return not encoded.startswith(f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$')
+
+
+def hash_many(passwords: list):
+    """
+    hash many passwords in the hashing pool, for bulk imports
+    passwords are sent by chunks of HASH_BULK_SIZE through the same slots as logins,
+    so logins wait at most for one chunk, not for the whole import
+    blocking, should not be called in the event loop
+    :param passwords: list of passwords
+    :return: list of hashes in the same order
+    """
+    hashes = []
+    for start in range(0, len(passwords), HASH_BULK_SIZE):
+        futures = [_submit(hash_password, password, wait=True)
+                   for password in passwords[start:start + HASH_BULK_SIZE]]
+        hashes.extend(future.result() for future in futures)
+    return hashes
+
+
+def _submit(func, *args, wait: bool = False):
+    """
+    run function in the hashing pool if there is a free slot
+    :param wait: True to wait for a free slot instead of raising HashingBusy
+    :return: concurrent.futures.Future
+    """
+    if not _slots.acquire(blocking=wait):
+        raise HashingBusy()
+    try:
+        future = HASH_POOL.submit(contextvars.copy_context().run, func, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda future: _slots.release())
+    return future
+
+
+async def ahash_password(password: str):
+    """
+    hash_password in the hashing pool
+    :param password: password to hash
+    :return: str hash
+    """
+    return await asyncio.wrap_future(_submit(hash_password, password))
+
+
+async def averify(password: str, encoded: str):
+    """
+    verify in the hashing pool
+    :param password: password to check
+    :param encoded: hash from the db
+    :return: bool
+    """
+    return await asyncio.wrap_future(_submit(verify, password, encoded))
@@ -1,15 +1,31 @@
+import asyncio
 import json
+import logging
+from functools import partial
 
 from typing import Optional
 from pydantic import BaseModel, ValidationError
-from fastapi import FastAPI, Request, status, File, UploadFile, Header
-from fastapi.responses import JSONResponse
-from sqlite3 import IntegrityError
-from models import Session, Customer, Admin, Banner, Product
+from fastapi import FastAPI, Request, status, Header, Query, Depends
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlite3 import IntegrityError, OperationalError
+from models import Session, SessionCheck, Customer, Admin, Banner, Product
+from models import PRODUCT_COLUMNS, PRODUCT_PAGE_SIZE, PRODUCT_PAGE_MAX, CATALOG
+from db_connection import POOL, EXECUTOR, WRITER, migrate, run_in_executor
+from uploads import (UPLOAD_FORM_OVERHEAD, UPLOAD_LIMITS, BadUpload, UploadTooLarge,
+                     discard, receive, safe_name, store)
+from hashing import HASH_POOL, HashingBusy
+from throttling import IP_ATTEMPTS, LOGIN_FAILURES
+from timing import JSONResponse, TimingMiddleware, span
 
-app = FastAPI()
+app = FastAPI(default_response_class=JSONResponse)
+app.add_middleware(TimingMiddleware)
+logger = logging.getLogger(__name__)
 
 STATIC_PATH = 'static/img/'
+EXPORT_LINES_PER_CHUNK = 100  # ndjson lines sent in one chunk of a streaming response
+SESSION_SWEEP_INTERVAL = 60  # seconds between deletes of expired sessions
+SESSION_TOUCH_INTERVAL = 5  # seconds between writes of sessions last activity
 
 
 class RequestBody(BaseModel):
@@ -19,153 +35,326 @@ class RequestBody(BaseModel):
     product: Product = None
 
 
+def hashing_busy():
+    """
+    response when the hashing pool is full
+    :return: response 503 + error in json, the client can retry in a second
+    """
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"error": "too many requests, try later"},
+                        headers={"Retry-After": "1"})
+
+
+def too_many_attempts(limiter):
+    """
+    response when login attempts are over the limit
+    :param limiter: throttling.RateLimiter that is over the limit
+    :return: response 429 + error in json
+    """
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        content={"error": "too many login attempts, try later"},
+                        headers={"Retry-After": str(limiter.retry_after())})
+
+
+def client_ip(request: Request):
+    """
+    address of the client
+    :param request: the request
+    :return: str or None if unknown
+    """
+    return request.client.host if request.client else None
+
+
+def session_dead(check: SessionCheck, session_id: Optional[str]):
+    """
+    response for a dead or not found session
+    :param check: result of Session.validate()
+    :param session_id: the id of the clint session from headers
+    :return: response 401 + session in json
+    """
+    if check.session is not None:
+        content = {"session": {"id": check.session.id, "authorized": check.session.authorized}}
+    else:
+        content = {"session": {"id": session_id, "authorized": False}}
+    return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
+                        content=json.dumps(content))
+
+
+class SessionDead(Exception):
+    """
+    the session of the request is dead or not found
+    """
+    def __init__(self, check: SessionCheck, session_id: Optional[str]):
+        super().__init__(session_id)
+        self.check = check
+        self.session_id = session_id
+
+
+class NotAdmin(Exception):
+    """
+    the session of the request is not linked to an admin
+    """
+
+
+@app.exception_handler(SessionDead)
+async def session_dead_handler(request: Request, exc: SessionDead):
+    """
+    response 401 + session in json, see session_dead
+    """
+    return session_dead(exc.check, exc.session_id)
+
+
+@app.exception_handler(NotAdmin)
+async def not_admin_handler(request: Request, exc: NotAdmin):
+    """
+    response 403
+    """
+    return JSONResponse(status_code=status.HTTP_403_FORBIDDEN)
+
+
+async def resolve_session(request: Request, session_id: Optional[str], token: Optional[str]):
+    """
+    validate the session of the request once, the result is kept in request.state
+    :param request: the request
+    :param session_id: the id of the clint session from headers
+    :param token: the token of the clint session from headers
+    :return: live session, SessionDead is raised if it is dead
+    """
+    check = getattr(request.state, 'session_check', None)
+    if check is None:
+        with span('session'):
+            check = await Session.avalidate(session_id, token)
+        request.state.session_check = check
+    if not check.live:
+        raise SessionDead(check, session_id)
+    request.state.session = check.session
+    return check.session
+
+
+async def current_session(request: Request,
+                          x_session_token: Optional[str] = Header(None),
+                          x_session_id: Optional[str] = Header(None)):
+    """
+    dependency: live session of the request, 401 + session in json if it is dead
+    :param request: the request
+    :param x_session_id: the id of the clint session
+    :param x_session_token: the token of the clint session
+    :return: Session
+    """
+    return await resolve_session(request, x_session_id, x_session_token)
+
+
+async def admin_session(session: Session = Depends(current_session)):
+    """
+    dependency: live session linked to an admin, 403 if it is not
+    :param session: live session of the request
+    :return: Session
+    """
+    if session.admin is None:
+        raise NotAdmin()
+    return session
+
+
+async def sweep_sessions():
+    """
+    background task to delete expired sessions
+    :return: None, runs until cancelled
+    """
+    while True:
+        try:
+            await Session.asweep()
+        except OperationalError:
+            logger.exception("expired sessions sweep failed")
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+
+async def flush_session_touches():
+    """
+    background task to write last activity of sessions in batches
+    :return: None, runs until cancelled
+    """
+    while True:
+        await asyncio.sleep(SESSION_TOUCH_INTERVAL)
+        try:
+            await Session.aflush_touches()
+        except OperationalError:
+            logger.exception("sessions last activity flush failed")
+
+
+@app.on_event("startup")
+async def startup():
+    """
+    migrate the db schema and start background tasks on server start
+    """
+    migrate()
+    app.state.sweeper = asyncio.create_task(sweep_sessions())
+    app.state.toucher = asyncio.create_task(flush_session_touches())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    stop background tasks, write buffered sessions activity,
+    stop the hashing pool, the database executor and writer, close pooled connections on server stop
+    """
+    app.state.sweeper.cancel()
+    app.state.toucher.cancel()
+    await Session.aflush_touches()
+    HASH_POOL.shutdown()
+    EXECUTOR.shutdown()
+    WRITER.stop()
+    POOL.close()
+
+
 @app.get("/web/api/token")
 async def token():
     """
     the path to get token and register new session
     :return: json {"session": {"id": session.id, "token": session.token}}
     """
-    session = Session.create()
+    session = await Session.acreate()
     return {"session": {"id": session.id, "token": session.token}}
 
 
 @app.get("/web/api/auth/client")
-async def auth(authorization: Optional[str] = Header(None),
+async def auth(request: Request,
+               authorization: Optional[str] = Header(None),
                x_session_token: Optional[str] = Header(None),
                x_session_id: Optional[str] = Header(None)):
     """
     the path to auth to the site by password and phone number
+    :param request: the request, to know the client address
     :param authorization: "telephone: password"
     :param x_session_id: the id of the clint session
     :param x_session_token: the token of the clint session
     :return: response 400 if data incorrect + error in json, 401 if session is dead + session in json,
-    403 if password is incorrect or user is not found, 200 if auth ok + customer in json,
-    """
-    # check session is not dead
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
-    # check password
+    403 if password is incorrect or user is not found, 429 if there are too many attempts from the address
+    or wrong passwords for the telephone + error in json, 503 if passwords of too many users are checked,
+    200 if auth ok + customer and session in json,
+    the session token changes in signed session mode
+    """
+    # throttle before any db or hashing work
+    if not IP_ATTEMPTS.hit(client_ip(request)):
+        return too_many_attempts(IP_ATTEMPTS)
     try:
-        parse = authorization.split(": ")
-        telephone = parse[0]
-        password = [1]
-    except IndexError:
+        telephone, password = authorization.split(": ", 1)
+        telephone = int(telephone)
+    except (AttributeError, ValueError):
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
                             content={"error": "no authorization data found"})
-    customer = Customer(telephone=telephone, password=password)
+    key = f'customer:{telephone}'
+    # the attempt is counted before the password is checked, so concurrent attempts can not pass the limit
+    if not LOGIN_FAILURES.hit(key):
+        return too_many_attempts(LOGIN_FAILURES)
     try:
-        password_valid = customer.check_password(customer.password)
-    except IntegrityError:
-        return JSONResponse(status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
-                            content={"error": "customer not found"})
-    if password_valid is False:
+        # check session is not dead
+        session = await resolve_session(request, x_session_id, x_session_token)
+        # check password
+        login = await Customer.aauthenticate(telephone, password)
+    except HashingBusy:
+        LOGIN_FAILURES.undo(key)
+        return hashing_busy()
+    except BaseException:
+        LOGIN_FAILURES.undo(key)
+        raise
+    if login is None:
         return JSONResponse(status_code=status.HTTP_403_FORBIDDEN)
     else:
-        session.auth(customer.id)
-        return JSONResponse(status_code=status.HTTP_200_OK, content={"customer": dict(customer)})
+        LOGIN_FAILURES.reset(key)
+        await session.aauth(login.principal.id, login.writes)
+        return JSONResponse(status_code=status.HTTP_200_OK,
+                            content={"customer": dict(login.principal),
+                                     "session": {"id": session.id, "token": session.token}})
 
 
 @app.get("/web/api/auth/admin")
-async def auth(authorization: Optional[str] = Header(None),
+async def auth(request: Request,
+               authorization: Optional[str] = Header(None),
                x_session_token: Optional[str] = Header(None),
                x_session_id: Optional[str] = Header(None)):
     """
     the path to auth admin to the site by login and phone number
+    :param request: the request, to know the client address
     :param authorization: "login: password"
     :param x_session_id: the id of the clint session
     :param x_session_token: the token of the clint session
     :return: response 400 if data incorrect + error in json, 401 if session is dead + session in json,
-    403 if password is incorrect or admin is not found, 200 if auth ok,
-    """
-    # check session is not dead
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
-    # check password
+    403 if password is incorrect or admin is not found, 429 if there are too many attempts from the address
+    or wrong passwords for the login + error in json, 503 if passwords of too many users are checked,
+    200 if auth ok + session in json,
+    the session token changes in signed session mode
+    """
+    # throttle before any db or hashing work
+    if not IP_ATTEMPTS.hit(client_ip(request)):
+        return too_many_attempts(IP_ATTEMPTS)
     try:
-        parse = authorization.split(": ")
-        login = parse[0]
-        password = [1]
-    except IndexError:
+        login, password = authorization.split(": ", 1)
+    except (AttributeError, ValueError):
         return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
                             content={"error": "no authorization data found"})
-    admin = Admin(login=login, password=password)
+    key = f'admin:{login}'
+    # the attempt is counted before the password is checked, so concurrent attempts can not pass the limit
+    if not LOGIN_FAILURES.hit(key):
+        return too_many_attempts(LOGIN_FAILURES)
     try:
-        password_valid = admin.check_password()
-    except IntegrityError:
-        return JSONResponse(status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
-                            content={"error": "admin not found"})
-    if password_valid is False:
+        # check session is not dead
+        session = await resolve_session(request, x_session_id, x_session_token)
+        # check password
+        login = await Admin.aauthenticate(login, password)
+    except HashingBusy:
+        LOGIN_FAILURES.undo(key)
+        return hashing_busy()
+    except BaseException:
+        LOGIN_FAILURES.undo(key)
+        raise
+    if login is None:
         return JSONResponse(status_code=status.HTTP_403_FORBIDDEN)
     else:
-        session.auth_admin(admin.id)
-        return JSONResponse(status_code=status.HTTP_200_OK)
+        LOGIN_FAILURES.reset(key)
+        await session.aauth_admin(login.principal.id, login.writes)
+        return JSONResponse(status_code=status.HTTP_200_OK,
+                            content={"session": {"id": session.id, "token": session.token}})
 
 
 @app.post("/web/api/registration")
 async def registration(customer: Customer,
-                       x_session_token: Optional[str] = Header(None),
-                       x_session_id: Optional[str] = Header(None)):
+                       session: Session = Depends(current_session)):
     """
     the method to register new customer by telephone, name, password
     :param customer: in body json: {"customer: {"telephone": customer.telephone,
                                                "password": customer.password
                                                "name": customer.name}
-    :param x_session_id: the id of the clint session
-    :param x_session_token: the token of the clint session
+    :param session: live session of the request, see current_session
     :return: response 400 if json data incorrect + error in json, 401 if session is dead + session in json,
     405 if telephone not unique + error in json, 400 if customer data not found + error in json,
-    200 if auth ok + new customer in json
-    """
-    # check session live
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
+    503 if passwords of too many users are hashed, 200 if auth ok + new customer and session in json
+    """
     # register
     try:
-        customer.add()
+        await customer.aadd()
     except IntegrityError:
         return JSONResponse(status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
                             content={"error": "telephone not unique"})
-    session.auth(customer.id)
+    except HashingBusy:
+        return hashing_busy()
+    await session.aauth(customer.id)
     return JSONResponse(status_code=status.HTTP_200_OK,
-                        content={"customer": dict(customer)})
+                        content={"customer": dict(customer),
+                                 "session": {"id": session.id, "token": session.token}})
 
 
 @app.post("/web/api/item/{item}")
 async def get_item(item: str,
                    request: Request,
-                   x_session_token: Optional[str] = Header(None),
-                   x_session_id: Optional[str] = Header(None)):
+                   session: Session = Depends(admin_session)):
     """
     method only for admin  to post items to db
     :param item:
     :param request: in body: {type  of item: item in json to add}
-    :param x_session_id: the id of the clint session
-    :param x_session_token: the token of the clint session
+    :param session: live session of an admin, see admin_session
     :return: response 400 if json data incorrect + error in json, 401 if session is dead + session in json,
     200 if item saved + item in json
     """
-    # check session live
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
-    # check if session link to admin
-    if session.admin is None:
-        return JSONResponse(status_code=status.HTTP_403_FORBIDDEN)
     # add item
     body = await request.body()
     try:
@@ -176,7 +365,7 @@ async def get_item(item: str,
     if item == "banner":
         if body.banner:
             body.banner.pic = STATIC_PATH + "banner/" + body.banner.pic
-            body.banner.add()
+            await body.banner.aadd()
             return dict(body.banner)
         else:
             return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
@@ -184,36 +373,67 @@ async def get_item(item: str,
     if item == "product":
         if body.product:
             body.product.pic = STATIC_PATH + "product/" + body.product.pic
-            body.product.add()
+            await body.product.aadd()
             return dict(body.product)
         else:
             return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
                                 content={"error": "product data not found"})
 
 
+@app.get("/web/api/item/product/filter")
+async def filter_product(type: Optional[str] = None,
+                         price_min: Optional[int] = None,
+                         price_max: Optional[int] = None,
+                         discount: Optional[bool] = None,
+                         after_id: int = Query(0, ge=0),
+                         limit: int = Query(PRODUCT_PAGE_SIZE, ge=1, le=PRODUCT_PAGE_MAX),
+                         session: Session = Depends(current_session)):
+    """
+    find products by type, price range and discount in the in-memory catalog index
+    :param type: type of products, for example "Роза"
+    :param price_min: min price, included
+    :param price_max: max price, included
+    :param discount: true - only with discount, false - only without
+    :param after_id: id of the last product of the previous page
+    :param limit: max number of products on the page
+    :param session: live session of the request, see current_session
+    :return: response 401 if session is dead + session in json,
+    200 + {"products": [...], "next_after_id": id for the next page or null if it is the last}
+    """
+    index = await run_in_executor(CATALOG.get)
+    # bitmaps are as wide as the catalog, so the query is kept off the event loop
+    list_ = await run_in_executor(index.query, type, price_min, price_max, discount, after_id, limit)
+    next_after_id = list_[-1]['id'] if len(list_) == limit else None
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content={"products": list_, "next_after_id": next_after_id})
+
+
 @app.get("/web/api/item/{item}/{item_id}")
 async def get_item(item: str, item_id,
-                   x_session_token: Optional[str] = Header(None),
-                   x_session_id: Optional[str] = Header(None)):
+                   after_id: int = Query(0, ge=0),
+                   limit: int = Query(PRODUCT_PAGE_SIZE, ge=1, le=PRODUCT_PAGE_MAX),
+                   fields: Optional[str] = None,
+                   session: Session = Depends(current_session),
+                   if_none_match: Optional[str] = Header(None),
+                   accept_encoding: Optional[str] = Header(None)):
     """
     get item by type and id or alias
     :param item: type of the item (for example banner)
-    :param item_id: id or alias of the item
-    :param x_session_id: the id of the clint session
-    :param x_session_token: the token of the clint session
+    :param item_id: id or alias of the item, "all" for a page of products
+    :param after_id: for products/all - id of the last product of the previous page
+    :param limit: for products/all - max number of products on the page
+    :param fields: for products/all - columns to return, comma separated: "name,price"
+    :param session: live session of the request, see current_session
+    :param if_none_match: for products/all - etag of the page the client already has
+    :param accept_encoding: for products/all - gzip is used if accepted
     :return: response 405 if data incorrect + error in json, 401 if session is dead + session in json,
-    200 if ok + item in json
-    """
-    # check session live
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
+    400 if fields are unknown + error in json, 200 if ok + item in json,
+    for products/all {"products": [...], "next_after_id": id for the next page or null if it is the last}
+    with ETag, 304 if the page has not changed
+    """
     # find item
     if item == "banner":
-        banner = Banner.find({"alias": item_id})
+        banner = await Banner.afind({"alias": item_id})
         if banner:
             return dict(banner)
         else:
@@ -221,45 +441,185 @@ async def get_item(item: str, item_id,
                                 content={"error": "banner not found"})
     if item == "product":
         if item_id == 'all':
-            list_ = Product().find_many()
-            return JSONResponse(status_code=status.HTTP_200_OK,
-                                content=dict(list_))
+            columns = PRODUCT_COLUMNS
+            if fields:
+                columns = ['id'] + [field for field in fields.split(',') if field != 'id']
+                if not set(columns) <= set(PRODUCT_COLUMNS):
+                    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                                        content={"error": "unknown fields"})
+            entry = await run_in_executor(CATALOG.response, ('page', after_id, limit, tuple(columns)),
+                                          partial(product_page, after_id=after_id, limit=limit, columns=columns))
+            return encoded_response(entry, if_none_match, accept_encoding)
         else:
-            product = Product().find_many({'id': item_id})
+            product = await Product().afind_many({'id': item_id})
             if product:
-                return dict(product)
+                return dict(product[0])
             else:
                 return JSONResponse(status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
                                     content={"error": "product not found"})
 
 
+@app.get("/web/api/search")
+async def search_product(q: str = Query(..., min_length=1, max_length=200),
+                         offset: int = Query(0, ge=0),
+                         limit: int = Query(PRODUCT_PAGE_SIZE, ge=1, le=PRODUCT_PAGE_MAX),
+                         session: Session = Depends(current_session)):
+    """
+    full-text search of products by name and type
+    :param q: search text, every word is a prefix, for example "роза ал"
+    :param offset: number of the best products to skip
+    :param limit: max number of products on the page
+    :param session: live session of the request, see current_session
+    :return: response 401 if session is dead + session in json,
+    200 + {"products": [...] the most relevant first, "next_offset": offset for the next page or null}
+    """
+    list_ = await Product.asearch(q, limit, offset)
+    next_offset = offset + limit if len(list_) == limit else None
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content={"products": [dict(product) for product in list_],
+                                 "next_offset": next_offset})
+
+
+def accepts_gzip(accept_encoding: Optional[str]):
+    """
+    check if gzip is acceptable by Accept-Encoding header, with its q-values:
+    "gzip;q=0" refuses gzip, "*" accepts it if gzip is not listed
+    :param accept_encoding: value of Accept-Encoding header
+    :return: bool
+    """
+    if not accept_encoding:
+        return False
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+def encoded_response(entry, if_none_match: Optional[str], accept_encoding: Optional[str]):
+    """
+    response from pre-encoded content with etag,
+    304 if the client has the same version, gzipped body if the client accepts it,
+    the gzipped body has its own etag, see Encoded.gzipped_etag
+    :param entry: catalog.Encoded
+    :param if_none_match: value of If-None-Match header
+    :param accept_encoding: value of Accept-Encoding header
+    :return: Response
+    """
+    gzipped = entry.gzipped is not None and accepts_gzip(accept_encoding)
+    headers = {"ETag": entry.gzipped_etag if gzipped else entry.etag,
+               "Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+    if if_none_match:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        # both etags are of the same content, so either is a match
+        if '*' in tags or entry.etag in tags or entry.gzipped_etag in tags:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return Response(entry.gzipped, media_type="application/json", headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+def product_page(index, after_id: int, limit: int, columns: list):
+    """
+    content of a page of products from the catalog index
+    :param index: catalog.CatalogIndex
+    :param after_id: id of the last product of the previous page
+    :param limit: max number of products on the page
+    :param columns: names of product attrs to return
+    :return: {"products": [...], "next_after_id": id for the next page or null if it is the last}
+    """
+    list_ = index.page(after_id, limit)
+    next_after_id = list_[-1]['id'] if len(list_) == limit else None
+    return {"products": [{column: product[column] for column in columns} for product in list_],
+            "next_after_id": next_after_id}
+
+
+def ndjson(records):
+    """
+    serialize records to ndjson by chunks of lines
+    :param records: iterable of json serializable objects
+    :return: generator of bytes
+    """
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False))
+        if len(lines) == EXPORT_LINES_PER_CHUNK:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+@app.get("/web/api/export/product")
+async def export_product(session: Session = Depends(admin_session)):
+    """
+    method only for admin to export all products, one json object per line
+    the response is streamed, products are read from the db while sending
+    :param session: live session of an admin, see admin_session
+    :return: response 401 if session is dead + session in json, 403 if session is not admin,
+    200 + products in ndjson
+    """
+    return StreamingResponse(ndjson(Product.iter_all()), media_type="application/x-ndjson")
+
+
 @app.post("/web/api/upload/{item}")
-async def upload(item: str, image: UploadFile = File(...),
-                 x_session_token: Optional[str] = Header(None),
-                 x_session_id: Optional[str] = Header(None)):
+async def upload(item: str, request: Request,
+                 content_length: Optional[int] = Header(None),
+                 session: Session = Depends(current_session)):
     """
-    get item by type and id or alias
-    :param item: type of the item (for example banner)
-    :param image: image file
-    :param x_session_id: the id of the clint session
-    :param x_session_token: the token of the clint session
+    save uploaded image of an item, multipart form with the file in "image" field
+    the body is read only after the session and Content-Length are checked,
+    then it is parsed while it comes, counting its size, and the file is written
+    straight to a temporary file in the directory of the item
+    :param item: type of the item (banner or product)
+    :param request: request with multipart body
+    :param content_length: size of the body, checked against the limit of the item
+    :param session: live session of the request, see current_session
     :return: response 500 if server cant save file, 401 if session is dead + session in json,
-    200 if file saved + filename in json
-    """
-    # check session live
-    session = Session.find({"id": int(x_session_id), "token": x_session_token})
-    check = session.check_session_live()
-    if check is False:
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED,
-                            content=json.dumps({"session": {"id": session.id,
-                                                            "authorized": session.authorized}}))
-    file_name = STATIC_PATH + item + "/" + image.filename.replace(" ", "-")
+    400 if the item or the file is wrong + error in json, 413 if the file is too large + error in json,
+    200 if file saved + {"file_name", "size", "sha256"} in json
+    """
+    if item not in UPLOAD_LIMITS:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"error": "unknown item"})
+    limit = UPLOAD_LIMITS[item]
+    # the body can be chunked without Content-Length, so receive() counts it too
+    if content_length is not None and content_length > limit + UPLOAD_FORM_OVERHEAD:
+        return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            content={"error": "file is too large"})
+    directory = STATIC_PATH + item
     try:
-        with open(file_name, 'wb+') as f:
-            f.write(image.file.read())
-            f.close()
-    except FileNotFoundError:
-        JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    else:
-        return JSONResponse(status_code=status.HTTP_200_OK,
-                            content={"file_name": file_name})
+        image = await receive(request.stream(), request.headers.get("content-type"), "image", directory, limit)
+    except UploadTooLarge:
+        return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            content={"error": "file is too large"})
+    except BadUpload:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"error": "no image"})
+    except OSError:
+        logger.exception("can not save upload to %s", directory)
+        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if image is None:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"error": "no image"})
+    if safe_name(image.file_name) is None:
+        await run_in_threadpool(discard, image)
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"error": "no image"})
+    file_name = directory + "/" + safe_name(image.file_name)
+    try:
+        await run_in_threadpool(store, image, file_name)
+    except (OSError, ValueError):
+        logger.exception("can not save %s", file_name)
+        return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content={"file_name": file_name, "size": image.size, "sha256": image.sha256})
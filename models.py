@@ -1,12 +1,34 @@
-import hashlib
+import hmac
 import random
+import sqlite3
 import string
+import threading
 import time
-from datetime import datetime
+from typing import NamedTuple, Optional
 
 
 from pydantic import BaseModel
-from db_connection import DataBase
+import hashing
+import settings
+import tokens
+from cache import TTLCache
+from catalog import Catalog
+from db_connection import DataBase, fts_match, run_in_executor
+
+SESSION_LIFETIME = 600  # seconds since last activity
+SESSION_CACHE_SIZE = 10000  # sessions kept in memory
+SESSION_CACHE_TTL = 5  # seconds, bounds how long other workers see a revoked or reauthorized session
+SESSION_COLUMNS = ['id', 'token', 'last_activity', 'customer', 'authorized', 'admin', 'expires']
+SESSION_SWEEP_BATCH = 500  # expired sessions deleted in one transaction
+SESSION_TOUCH_THRESHOLD = 60  # seconds, last activity is not refreshed more often
+PRODUCT_COLUMNS = ['id', 'name', 'type', 'price', 'discount_check', 'pic']
+BANNER_COLUMNS = ['id', 'alias', 'title', 'text', 'pic']
+CUSTOMER_COLUMNS = ['id', 'telephone', 'name', 'email', 'personal_discount']  # password is never read back
+PRODUCT_PAGE_SIZE = 50
+PRODUCT_PAGE_MAX = 200
+PRODUCT_SEARCH_WEIGHTS = (10.0, 1.0)  # bm25 weights of name and type in the full-text search
+LEGACY_TIME_FORMAT = "%Y-%m-%d, %H:%M:%S"
+SESSION_MODE = settings.SESSION_MODE
 
 
 def generate_token():
@@ -19,37 +41,126 @@ def generate_token():
     return rand_string
 
 
+def to_epoch(last_activity):
+    """
+    convert session last activity from the db to epoch seconds
+    sessions written before are stored as local time strings "%Y-%m-%d, %H:%M:%S"
+    :param last_activity: value from the db
+    :return: int
+    """
+    if isinstance(last_activity, str):
+        return int(time.mktime(time.strptime(last_activity, LEGACY_TIME_FORMAT)))
+    return last_activity
+
+
+def hydrate(model, row, **values):
+    """
+    make the entity of a model from a trusted db row without pydantic validation,
+    values are converted by the model's _convert {column: function}, None is kept as is
+    :param model: class of the model
+    :param row: named db row, see DataBase.select
+    :param values: other attrs of the entity, replace values of the row
+    :return: the entity of the model
+    """
+    values = dict(zip(row._fields, row), **values)
+    for column, convert in model._convert.items():
+        if values.get(column) is not None:
+            values[column] = convert(values[column])
+    return model.construct(**values)
+
+
+def rehash_writes(table_name: str, row_id: int, password: str, encoded: str):
+    """
+    db writes to replace legacy or outdated password hash after successful check of the password,
+    nothing is changed if the hash in the db is already different
+    :param table_name: customer or admin
+    :param row_id: id of the record
+    :param password: checked password
+    :param encoded: its hash from the db
+    :return: list of operations for DataBase.write_many, empty if the hash is up to date
+    """
+    if not hashing.needs_rehash(encoded):
+        return []
+    return [('update', table_name, {'password': hashing.hash_password(password)},
+             {'id': row_id, 'password': encoded})]
+
+
+async def arehash_writes(table_name: str, row_id: int, password: str, encoded: str):
+    """
+    awaitable variant of rehash_writes(), the password is hashed in the hashing pool
+    :param table_name: customer or admin
+    :param row_id: id of the record
+    :param password: checked password
+    :param encoded: its hash from the db
+    :return: list of operations for DataBase.write_many
+    """
+    if not hashing.needs_rehash(encoded):
+        return []
+    return [('update', table_name, {'password': await hashing.ahash_password(password)},
+             {'id': row_id, 'password': encoded})]
+
+
+SESSION_CACHE = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+# {session id: last activity} waiting to be written by Session.flush_touches()
+SESSION_TOUCHES = {}
+SESSION_TOUCHES_LOCK = threading.Lock()
+
+
 class Session(BaseModel):
     """
     class to create and check current session
     """
     id: int
     _table: str = 'session'
+    _convert: dict = {'last_activity': to_epoch, 'authorized': bool}
     token: str
-    last_activity: str = None
+    last_activity: int = None
     customer: int = None
     authorized: bool = False
     admin: int = None
+    expires: int = None
 
     @staticmethod
     def create():
         """
         method to create new session
+        in signed mode the session is not saved to the db and has id 0
         :return: the entity of Session class
         """
+        last_activity = int(time.time())
+        expires = last_activity + SESSION_LIFETIME
+        if SESSION_MODE == 'signed':
+            session = Session(id=0, token='', last_activity=last_activity, expires=expires)
+            session._sign()
+            return session
         token = generate_token()
-        last_activity = time.strftime("%Y-%m-%d, %H:%M:%S", time.localtime())
-        DataBase().insert('session', {'token': token,
-                                      'last_activity': last_activity})
-        session_id = DataBase().select('session',
-                                       ['id'],
-                                       {'token': token,
-                                        'last_activity': last_activity})[0][0]
+        session_id = DataBase().insert('session', {'token': token,
+                                                   'last_activity': last_activity,
+                                                   'expires': expires})
         session = Session(id=session_id,
                           token=token,
-                          last_activity=last_activity)
+                          last_activity=last_activity,
+                          expires=expires)
+        SESSION_CACHE.set(session.id, session, SESSION_LIFETIME)
         return session
 
+    @staticmethod
+    async def acreate():
+        """
+        awaitable variant of create()
+        :return: the entity of Session class
+        """
+        return await run_in_executor(Session.create)
+
+    @staticmethod
+    def _from_row(row):
+        """
+        make the entity of Session class from a db row
+        :param row: named row with SESSION_COLUMNS
+        :return: the entity of Session class
+        """
+        return hydrate(Session, row)
+
     @staticmethod
     def find(search_data: dict):
         """
@@ -57,73 +168,320 @@ class Session(BaseModel):
         :param search_data
         :return: the entity of Session class
         """
-        result = DataBase().select('session', conditions=search_data)[0]
-        session = Session(id=result[0],
-                          token=result[1],
-                          last_activity=result[2],
-                          customer=result[3],
-                          authorized=bool(result[4]))
-        return session
+        result = DataBase().select('session', SESSION_COLUMNS, search_data, named=True)[0]
+        return Session._from_row(result)
 
-    def _fill_attrs(self):
+    @staticmethod
+    async def afind(search_data: dict):
         """
-        refresh session attrs
-        :return: None (refresh last_activity, customer, authorized)
+        awaitable variant of find()
+        :param search_data
+        :return: the entity of Session class
         """
-        search = DataBase().select(self._table,
-                                   conditions={'id': self.id,
-                                               'token': self.token})[0]
-        self.last_activity = search[2]
-        self.customer = search[3]
-        self.authorized = bool(search[4])
-        self.admin = search[5]
+        return await run_in_executor(Session.find, search_data)
 
-    def _check_time_delta(self):
+    @staticmethod
+    def validate(session_id, token):
         """
-        measure time delta between time now and last activity of the token
-        :return: time delta in minutes
+        check session by id and token and refresh its last activity
+        live sessions are cached, so the db is requested only on a cache miss
+        :param session_id: id of the session, as it comes in headers
+        :param token: token of the session
+        :return: SessionCheck, live is False if session is not found or expired
         """
-        time_format = "%Y-%m-%d, %H:%M:%S"
-        last_activity = datetime.strptime(self.last_activity, time_format)
-        time_now = time.strftime(time_format, time.localtime())
-        time_now = datetime.strptime(time_now, time_format)
-        delta = time_now - last_activity
-        return int(delta.seconds / 60)
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            return SessionCheck(False)
+        if token is None:
+            return SessionCheck(False)
+        if SESSION_MODE == 'signed':
+            return Session._validate_signed(session_id, token)
+        session = SESSION_CACHE.get(session_id)
+        if session is not None:
+            if not hmac.compare_digest(session.token.encode('utf-8'), token.encode('utf-8')):
+                return SessionCheck(False)
+        else:
+            result = DataBase().select('session', SESSION_COLUMNS, {'id': session_id, 'token': token},
+                                       named=True)
+            if not result:
+                return SessionCheck(False)
+            session = Session._from_row(result[0])
+            # the last activity can still wait in the buffer to be written
+            with SESSION_TOUCHES_LOCK:
+                last_activity = SESSION_TOUCHES.get(session.id)
+            if last_activity is not None and last_activity > session.last_activity:
+                session.last_activity = last_activity
+                session.expires = last_activity + SESSION_LIFETIME
+            if session.is_live():
+                session._touch()
+                SESSION_CACHE.set(session.id, session, session.expires - time.time())
+                return SessionCheck(True, session)
+        if not session.is_live():
+            return SessionCheck(False, session)
+        session._touch()
+        return SessionCheck(True, session)
+
+    @staticmethod
+    def _validate_signed(session_id: int, token: str):
+        """
+        check signed session token
+        the db is requested only for authorized sessions, to check they are not revoked:
+        the nonce of the token should be equal to the token of the session row
+        :param session_id: id of the session
+        :param token: signed token
+        :return: SessionCheck
+        """
+        data = tokens.unsign(token)
+        if data is None or data.get('id') != session_id:
+            return SessionCheck(False)
+        # the data is signed by us, so it is not validated again
+        session = Session.construct(id=session_id,
+                                    token=token,
+                                    last_activity=data['exp'] - SESSION_LIFETIME,
+                                    customer=data.get('customer'),
+                                    authorized=bool(data.get('authorized', False)),
+                                    admin=data.get('admin'),
+                                    expires=data['exp'])
+        if not session.is_live():
+            return SessionCheck(False, session)
+        if session.id:
+            cached = SESSION_CACHE.get(session.id)
+            if cached is None or cached.token != token:
+                row = DataBase().select('session', ['token'], {'id': session.id}, named=True)
+                if not row or not hmac.compare_digest(row[0].token, str(data.get('nonce'))):
+                    return SessionCheck(False)
+                SESSION_CACHE.set(session.id, session, session.expires - time.time())
+        return SessionCheck(True, session)
+
+    def _sign(self, nonce: str = None):
+        """
+        put session state to a new signed token
+        :param nonce: random string, the token of the session row for saved sessions
+        :return: None (change self.token)
+        """
+        self.token = tokens.sign({'id': self.id,
+                                  'exp': self.expires,
+                                  'customer': self.customer,
+                                  'authorized': self.authorized,
+                                  'admin': self.admin,
+                                  'nonce': nonce or generate_token()[:8]})
+
+    def _auth_signed(self, values: dict, writes: tuple = ()):
+        """
+        save authorized signed session to the db and reissue its token
+        :param values: session columns to set
+        :param writes: other db operations to commit in the same transaction
+        :return: None (change self.id, self.token and auth attrs)
+        """
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.authorized = True
+        self.last_activity = int(time.time())
+        self.expires = self.last_activity + SESSION_LIFETIME
+        nonce = generate_token()
+        row = {'token': nonce, 'customer': self.customer, 'admin': self.admin,
+               'authorized': True, 'last_activity': self.last_activity, 'expires': self.expires}
+        if self.id == 0:
+            self.id = DataBase().write_many([*writes, ('insert', self._table, row)])[-1]
+        else:
+            DataBase().write_many([*writes, ('update', self._table, row, {'id': self.id})])
+        SESSION_CACHE.pop(self.id)
+        self._sign(nonce)
+
+    def _touch(self):
+        """
+        slide session expiry, if last activity is older than SESSION_TOUCH_THRESHOLD
+        the db is not written here, touches are buffered for flush_touches()
+        the cached entry is changed in place, its time to live is not extended,
+        so the session is reread from the db at least every SESSION_CACHE_TTL
+        :return: None (change self.last_activity and self.expires)
+        """
+        now = int(time.time())
+        if now - self.last_activity < SESSION_TOUCH_THRESHOLD:
+            return
+        self.last_activity = now
+        self.expires = now + SESSION_LIFETIME
+        with SESSION_TOUCHES_LOCK:
+            SESSION_TOUCHES[self.id] = now
+
+    @staticmethod
+    def flush_touches():
+        """
+        write buffered last activity of sessions with one executemany
+        :return: number of touched sessions
+        """
+        with SESSION_TOUCHES_LOCK:
+            touches = SESSION_TOUCHES.copy()
+            SESSION_TOUCHES.clear()
+        rows = [{'id': session_id, 'last_activity': last_activity,
+                 'expires': last_activity + SESSION_LIFETIME}
+                for session_id, last_activity in touches.items()]
+        try:
+            DataBase().update_many('session', rows, 'id')
+        except sqlite3.Error:
+            with SESSION_TOUCHES_LOCK:
+                for session_id, last_activity in touches.items():
+                    SESSION_TOUCHES.setdefault(session_id, last_activity)
+            raise
+        return len(rows)
+
+    @staticmethod
+    async def aflush_touches():
+        """
+        awaitable variant of flush_touches()
+        :return: number of touched sessions
+        """
+        return await run_in_executor(Session.flush_touches)
+
+    @staticmethod
+    async def avalidate(session_id, token):
+        """
+        awaitable variant of validate()
+        :param session_id: id of the session, as it comes in headers
+        :param token: token of the session
+        :return: SessionCheck
+        """
+        return await run_in_executor(Session.validate, session_id, token)
+
+    def is_live(self, now: int = None):
+        """
+        check expiry of the session without a request to the db
+        :param now: epoch seconds, time.time() if not provided
+        :return: bool
+        """
+        if now is None:
+            now = time.time()
+        return now < self.expires
 
     def check_session_live(self):
         """
         method to check if token valid and lives
+        refresh session attrs from the db
         :return: bool
         """
-        try:
-            self._fill_attrs()
-        except IndexError:
-            return False
-        delta = self._check_time_delta()
-        if delta < 10:
-            return True
-        else:
+        check = Session.validate(self.id, self.token)
+        if check.session is None:
             return False
+        self.last_activity = check.session.last_activity
+        self.customer = check.session.customer
+        self.authorized = check.session.authorized
+        self.admin = check.session.admin
+        self.expires = check.session.expires
+        return check.live
+
+    async def acheck_session_live(self):
+        """
+        awaitable variant of check_session_live()
+        :return: bool
+        """
+        return await run_in_executor(self.check_session_live)
 
-    def auth(self, customer_id: int):
+    def auth(self, customer_id: int, writes: tuple = ()):
         """
         links session to a customer if authorize
+        in signed mode the session gets new id and token
         :param customer_id: id of the customer to link to the session
+        :param writes: other db operations to commit in the same transaction, see Login
         :return: None
         """
-        DataBase().update(self._table,
-                          values={'customer': customer_id, 'authorized': True},
-                          conditions={'id': self.id})
+        if SESSION_MODE == 'signed':
+            self._auth_signed({'customer': customer_id}, writes)
+            return
+        DataBase().write_many([*writes, ('update', self._table, {'customer': customer_id, 'authorized': True},
+                                         {'id': self.id})])
+        SESSION_CACHE.pop(self.id)
 
-    def auth_admin(self, admin: int):
+    async def aauth(self, customer_id: int, writes: tuple = ()):
+        """
+        awaitable variant of auth()
+        :param customer_id: id of the customer to link to the session
+        :param writes: other db operations to commit in the same transaction
+        :return: None
+        """
+        await run_in_executor(self.auth, customer_id, writes)
+
+    def auth_admin(self, admin: int, writes: tuple = ()):
         """
         links session to a admin if authorize
+        in signed mode the session gets new id and token
         :param admin: id of the admin to link to the session
+        :param writes: other db operations to commit in the same transaction, see Login
         :return: None
         """
-        DataBase().update(self._table,
-                          values={'admin': admin, 'authorized': True},
-                          conditions={'id': self.id})
+        if SESSION_MODE == 'signed':
+            self._auth_signed({'admin': admin}, writes)
+            return
+        DataBase().write_many([*writes, ('update', self._table, {'admin': admin, 'authorized': True},
+                                         {'id': self.id})])
+        SESSION_CACHE.pop(self.id)
+
+    async def aauth_admin(self, admin: int, writes: tuple = ()):
+        """
+        awaitable variant of auth_admin()
+        :param admin: id of the admin to link to the session
+        :param writes: other db operations to commit in the same transaction
+        :return: None
+        """
+        await run_in_executor(self.auth_admin, admin, writes)
+
+    @staticmethod
+    def sweep(batch_size: int = SESSION_SWEEP_BATCH):
+        """
+        delete one batch of expired sessions, uses the index on session.expires
+        sessions with buffered touches are kept, their expiry in the db is not moved yet
+        :param batch_size: max number of sessions to delete
+        :return: number of deleted sessions
+        """
+        with SESSION_TOUCHES_LOCK:
+            touched = list(SESSION_TOUCHES)
+        return DataBase().delete_below('session', 'expires', int(time.time()), batch_size, keep=touched)
+
+    @staticmethod
+    async def asweep(batch_size: int = SESSION_SWEEP_BATCH):
+        """
+        delete all expired sessions batch by batch,
+        every batch is a short transaction, so requests are not blocked for long
+        :param batch_size: max number of sessions to delete in one transaction
+        :return: number of deleted sessions
+        """
+        deleted = 0
+        while True:
+            count = await run_in_executor(Session.sweep, batch_size)
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    def revoke(self):
+        """
+        delete session from the db, signed tokens of the session stop working too
+        :return: None
+        """
+        DataBase().delete(self._table, {'id': self.id})
+        SESSION_CACHE.pop(self.id)
+
+    async def arevoke(self):
+        """
+        awaitable variant of revoke()
+        :return: None
+        """
+        await run_in_executor(self.revoke)
+
+
+class SessionCheck(NamedTuple):
+    """
+    result of session validation
+    """
+    live: bool
+    session: Optional[Session] = None
+
+
+class Login(NamedTuple):
+    """
+    result of successful check of a password
+    """
+    principal: BaseModel  # Customer or Admin, password is hidden
+    writes: tuple = ()  # db operations to commit with the session auth, see Session.auth
 
 
 class Admin(BaseModel):
@@ -133,27 +491,53 @@ class Admin(BaseModel):
     """
     id: int = None
     _table: str = "admin"
+    _convert: dict = {}
     login: str
     password: str
 
+    @staticmethod
+    def authenticate(login: str, password: str):
+        """
+        check login and password, the admin is found by the unique login with one query
+        a legacy md5 hash is replaced with a new one in Login.writes
+        :param login: login of the admin
+        :param password: input password to check
+        :return: Login with the admin, None if the login or the password is wrong
+        """
+        db = DataBase().select('admin', ['id', 'login', 'password'], {'login': login}, named=True)
+        if not db or not hashing.verify(password, db[0].password):
+            return None
+        return Login(hydrate(Admin, db[0], password='***'),
+                     rehash_writes('admin', db[0].id, password, db[0].password))
+
+    @staticmethod
+    async def aauthenticate(login: str, password: str):
+        """
+        awaitable variant of authenticate(), the password is hashed in the hashing pool
+        :param login: login of the admin
+        :param password: input password to check
+        :return: Login with the admin, None if the login or the password is wrong
+        """
+        db = await run_in_executor(DataBase().select, 'admin', ['id', 'login', 'password'], {'login': login},
+                                   named=True)
+        if not db or not await hashing.averify(password, db[0].password):
+            return None
+        return Login(hydrate(Admin, db[0], password='***'),
+                     await arehash_writes('admin', db[0].id, password, db[0].password))
+
     def check_password(self):
         """
-        method to check password
-        incrypt input password and check if it equal to the db one
+        method to check password, see authenticate
         :return: bool
         """
-        enc = hashlib.md5()
-        enc.update(self.password.encode('utf-8'))
-        self.password = enc.hexdigest()
-        db = DataBase().select(self._table, ['id', 'password'], {'login': self.login})[0]
-        admin_id = db[0]
-        password_db = db[1]
-        if self.password == password_db:
-            self.id = admin_id
-            self.password = '***'
-            return True
-        else:
+        login = Admin.authenticate(self.login, self.password)
+        if login is None:
             return False
+        if login.writes:
+            DataBase().write_many(login.writes)
+        self.id = login.principal.id
+        self.password = '***'
+        return True
 
 
 class Banner(BaseModel):
@@ -162,6 +546,7 @@ class Banner(BaseModel):
     """
     id: int = None
     _table: str = "banner"
+    _convert: dict = {}
     alias: str
     title: str = None
     text: str = None
@@ -174,24 +559,29 @@ class Banner(BaseModel):
         :param search_data:
         :return: the entity of Banner class
         """
-        result = DataBase().select('banner', conditions=search_data)[0]
-        banner = Banner(id=result[0],
-                        alias=result[1],
-                        title=result[2],
-                        text=result[3],
-                        pic=result[4])
-        return banner
+        result = DataBase().select('banner', BANNER_COLUMNS, search_data, named=True)[0]
+        return hydrate(Banner, result)
+
+    @staticmethod
+    async def afind(search_data: dict):
+        """
+        awaitable variant of find()
+        :param search_data:
+        :return: the entity of Banner class
+        """
+        return await run_in_executor(Banner.find, search_data)
 
     def _fill_attrs(self):
         """
         refresh banner attrs
         :return: None (refresh attrs)
         """
-        result = DataBase().select(self._table, conditions={'alias': self.alias})[0]
-        self.id = result[0]
-        self.title = result[2]
-        self.text = result[3]
-        self.pic = result[4]
+        result = DataBase().select(self._table, ['id', 'title', 'text', 'pic'], {'alias': self.alias},
+                                   named=True)[0]
+        self.id = result.id
+        self.title = result.title
+        self.text = result.text
+        self.pic = result.pic
 
     def add(self):
         """
@@ -199,9 +589,14 @@ class Banner(BaseModel):
         change self.id to one, that added in the db
         :return: None (change self.id to one, added in the db)
         """
-        DataBase().insert(self._table, dict(self))
-        search = self.find({'alias': self.alias})
-        self.alias = search.alias
+        self.id = DataBase().insert(self._table, dict(self))
+
+    async def aadd(self):
+        """
+        awaitable variant of add()
+        :return: None (change self.id to one, added in the db)
+        """
+        await run_in_executor(self.add)
 
     def update(self, values: dict):
         """
@@ -216,6 +611,14 @@ class Banner(BaseModel):
         self.text = search.text
         self.pic = search.pic
 
+    async def aupdate(self, values: dict):
+        """
+        awaitable variant of update()
+        :param values: values to update in db
+        :return: None (refresh banner attrs after adding)
+        """
+        await run_in_executor(self.update, values)
+
 
 class Customer(BaseModel):
     """
@@ -223,6 +626,7 @@ class Customer(BaseModel):
     """
     id: int = None
     _table: str = "customer"
+    _convert: dict = {'personal_discount': str}
     telephone: int
     password: str
     name: str = None
@@ -236,26 +640,30 @@ class Customer(BaseModel):
         :param search_data:
         :return: the entity of Customer class
         """
-        result = DataBase().select('customer', conditions=search_data)[0]
-        customer = Customer(id=result[0],
-                            telephone=result[1],
-                            password='***',
-                            name=result[3],
-                            email=result[4],
-                            personal_discount=result[5])
-        return customer
+        result = DataBase().select('customer', CUSTOMER_COLUMNS, search_data, named=True)[0]
+        return hydrate(Customer, result, password='***')
+
+    @staticmethod
+    async def afind(search_data: dict):
+        """
+        awaitable variant of find()
+        :param search_data:
+        :return: the entity of Customer class
+        """
+        return await run_in_executor(Customer.find, search_data)
 
     def _fill_attrs(self):
         """
         refresh customer attrs
         :return: None (refresh data)
         """
-        result = DataBase().select(self._table, conditions={'telephone': self.telephone})[0]
-        self.id = result[0]
+        result = DataBase().select(self._table, ['id', 'name', 'email', 'personal_discount'],
+                                   {'telephone': self.telephone}, named=True)[0]
+        self.id = result.id
         self.password = '***'
-        self.name = result[3]
-        self.email = result[4]
-        self.personal_discount = result[5]
+        self.name = result.name
+        self.email = result.email
+        self.personal_discount = result.personal_discount
 
     def add(self):
         """
@@ -264,14 +672,44 @@ class Customer(BaseModel):
         change self.id to one, that added in the db
         :return: None (change self.id to one, added in the db)
         """
-        enc = hashlib.md5()
-        enc.update(self.password.encode('utf-8'))
-        self.password = enc.hexdigest()
-        DataBase().insert(self._table, dict(self))
-        search = self.find({'telephone': self.telephone})
-        self.id = search.id
+        self.password = hashing.hash_password(self.password)
+        self.id = DataBase().insert(self._table, dict(self))
+        self.password = '***'
+
+    async def aadd(self):
+        """
+        awaitable variant of add(), the password is hashed in the hashing pool
+        :return: None (change self.id to one, added in the db)
+        """
+        self.password = await hashing.ahash_password(self.password)
+        self.id = await run_in_executor(DataBase().insert, self._table, dict(self))
         self.password = '***'
 
+    @staticmethod
+    def add_many(customers: list):
+        """
+        add many customers to a database in one transaction
+        if a telephone is not unique nothing is added
+        :param customers: list of the entities of Customer class
+        :return: None (change id and password of every customer)
+        """
+        passwords = hashing.hash_many([customer.password for customer in customers])
+        for customer, password in zip(customers, passwords):
+            customer.password = password
+        ids = DataBase().insert_many(Customer._table, [dict(customer) for customer in customers])
+        for customer, customer_id in zip(customers, ids):
+            customer.id = customer_id
+            customer.password = '***'
+
+    @staticmethod
+    async def aadd_many(customers: list):
+        """
+        awaitable variant of add_many()
+        :param customers: list of the entities of Customer class
+        :return: None (change id and password of every customer)
+        """
+        await run_in_executor(Customer.add_many, customers)
+
     def update(self, values: dict):
         """
         update values in db
@@ -287,24 +725,64 @@ class Customer(BaseModel):
         self.email = search.email
         self.personal_discount = search.personal_discount
 
+    async def aupdate(self, values: dict):
+        """
+        awaitable variant of update()
+        :param values: values to update in db
+        :return: None (refresh customer attrs after adding)
+        """
+        await run_in_executor(self.update, values)
+
+    @staticmethod
+    def authenticate(telephone: int, password: str):
+        """
+        check telephone and password, the hash and the customer data are selected
+        by the unique telephone with one query
+        a legacy md5 hash is replaced with a new one in Login.writes
+        :param telephone: telephone of the customer
+        :param password: input password to check
+        :return: Login with the customer, None if the telephone or the password is wrong
+        """
+        check = DataBase().select('customer', CUSTOMER_COLUMNS + ['password'], {'telephone': telephone},
+                                  named=True)
+        if not check or not hashing.verify(password, check[0].password):
+            return None
+        return Login(hydrate(Customer, check[0], password='***'),
+                     rehash_writes('customer', check[0].id, password, check[0].password))
+
+    @staticmethod
+    async def aauthenticate(telephone: int, password: str):
+        """
+        awaitable variant of authenticate(), the password is hashed in the hashing pool
+        :param telephone: telephone of the customer
+        :param password: input password to check
+        :return: Login with the customer, None if the telephone or the password is wrong
+        """
+        check = await run_in_executor(DataBase().select, 'customer', CUSTOMER_COLUMNS + ['password'],
+                                      {'telephone': telephone}, named=True)
+        if not check or not await hashing.averify(password, check[0].password):
+            return None
+        return Login(hydrate(Customer, check[0], password='***'),
+                     await arehash_writes('customer', check[0].id, password, check[0].password))
+
     def check_password(self, password):
         """
-        method to check password
-        incrypt input password and check if it equal to the db one
+        method to check password, see authenticate
         :param password: input password to check
         :return: Bool
         """
-        try:
-            check = DataBase().select(self._table, ['password'], {'telephone': self.telephone})[0][0]
-        except IndexError:
-            return False
-        enc = hashlib.md5(password.encode('utf-8'))
-        password = enc.hexdigest()
-        if check == password:
-            self._fill_attrs()
-            return True
-        else:
+        login = Customer.authenticate(self.telephone, password)
+        if login is None:
             return False
+        if login.writes:
+            DataBase().write_many(login.writes)
+        customer = login.principal
+        self.id = customer.id
+        self.password = '***'
+        self.name = customer.name
+        self.email = customer.email
+        self.personal_discount = customer.personal_discount
+        return True
 
 
 class Product(BaseModel):
@@ -313,6 +791,7 @@ class Product(BaseModel):
     """
     id: int = None
     _table: str = "product"
+    _convert: dict = {'discount_check': bool}
     name: str = None
     type: str = None
     price: int = None
@@ -325,37 +804,111 @@ class Product(BaseModel):
         :param search_data: dict of conditions to search
         :return: list of products
         """
-        result = DataBase().select(self._table, conditions=search_data)
-        list_ = []
-        for product in result:
-            product = Product(id=product[0],
-                              name=product[1],
-                              type=product[2],
-                              price=product[3],
-                              discount_check=bool(product[4]),
-                              pic=product[5])
-            list_.append(product)
-        return list_
+        result = DataBase().select(self._table, PRODUCT_COLUMNS, search_data, named=True)
+        return [hydrate(Product, row) for row in result]
+
+    async def afind_many(self, search_data: dict = None):
+        """
+        awaitable variant of find_many()
+        :param search_data: dict of conditions to search
+        :return: list of products
+        """
+        return await run_in_executor(self.find_many, search_data)
+
+    @staticmethod
+    def search(text: str, limit: int = PRODUCT_PAGE_SIZE, offset: int = 0):
+        """
+        full-text search of products by name and type, words of the text are used as prefixes,
+        case and diacritics are ignored
+        :param text: search text, for example "роза ал"
+        :param limit: max number of products on the page
+        :param offset: number of the best products to skip
+        :return: list of products, the most relevant first
+        """
+        match = fts_match(text)
+        if not match:
+            return []
+        result = DataBase().search(Product._table, 'product_fts', match, PRODUCT_COLUMNS,
+                                   PRODUCT_SEARCH_WEIGHTS, limit, offset, named=True)
+        return [hydrate(Product, row) for row in result]
+
+    @staticmethod
+    async def asearch(text: str, limit: int = PRODUCT_PAGE_SIZE, offset: int = 0):
+        """
+        awaitable variant of search()
+        :param text: search text
+        :param limit: max number of products on the page
+        :param offset: number of the best products to skip
+        :return: list of products
+        """
+        return await run_in_executor(Product.search, text, limit, offset)
+
+    @staticmethod
+    def iter_all():
+        """
+        iterate over all products ordered by id without loading them to memory
+        :return: generator of dicts {column name: value}
+        """
+        for row in DataBase().iter_select(Product._table, PRODUCT_COLUMNS, order_by='id', named=True):
+            product = row._asdict()
+            product['discount_check'] = bool(product['discount_check'])
+            yield product
 
     def _fill_attrs(self):
         """
         refresh product attrs
         :return: None (refresh data)
         """
-        result = DataBase().select(self._table, conditions={'id': self.id})[0]
-        self.name = result[1]
-        self.type = result[2]
-        self.price = result[3]
-        self.discount_check = result[4]
-        self.pic = result[5]
+        result = DataBase().select(self._table, PRODUCT_COLUMNS, {'id': self.id}, named=True)[0]
+        self.name = result.name
+        self.type = result.type
+        self.price = result.price
+        self.discount_check = result.discount_check
+        self.pic = result.pic
 
     def add(self):
         """
         add product to a database from exemplar of the class
         :return: None (change self.id)
         """
-        DataBase().insert(self._table, dict(self))
-        search = self.find_many({'name': self.name, 'type': self.type})[0]
-        self.id = search.id
-        self._fill_attrs()
+        self.id = DataBase().insert(self._table, dict(self))
+        CATALOG.invalidate()
+
+    async def aadd(self):
+        """
+        awaitable variant of add()
+        :return: None (change self.id)
+        """
+        await run_in_executor(self.add)
+
+    @staticmethod
+    def add_many(products: list):
+        """
+        add many products to a database in one transaction
+        :param products: list of the entities of Product class
+        :return: None (change id of every product)
+        """
+        ids = DataBase().insert_many(Product._table, [dict(product) for product in products])
+        for product, product_id in zip(products, ids):
+            product.id = product_id
+        CATALOG.invalidate()
+
+    @staticmethod
+    async def aadd_many(products: list):
+        """
+        awaitable variant of add_many()
+        :param products: list of the entities of Product class
+        :return: None (change id of every product)
+        """
+        await run_in_executor(Product.add_many, products)
+
+
+def product_version():
+    """
+    catalog version, changed by triggers on any write to product
+    :return: int
+    """
+    return DataBase().select('meta', ['value'], {'key': 'product_version'}, named=True)[0].value
+
 
+CATALOG = Catalog(Product.iter_all, product_version)
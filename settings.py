@@ -0,0 +1,20 @@
+import os
+
+from dotenv import load_dotenv
+
+# values from .env file in the working directory, real environment variables take precedence
+load_dotenv()
+
+DATABASE_FILE = os.environ.get('DATABASE_FILE', 'db.db')
+
+# "db" - every session is a row in the db,
+# "signed" - session state is kept in a signed token, only authorized sessions have a row
+SESSION_MODE = os.environ.get('SESSION_MODE', 'db')
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+
+# sqlite storage: a preset from db_connection.STORAGE_PROFILES ("durable" or "fast"),
+# single pragmas of the preset can be replaced by SQLITE_<PRAGMA> variables
+STORAGE_PROFILE = os.environ.get('STORAGE_PROFILE', 'durable')
+STORAGE_PRAGMAS = ['journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout']
+STORAGE_OVERRIDES = {pragma: os.environ[f'SQLITE_{pragma.upper()}']
+                     for pragma in STORAGE_PRAGMAS if f'SQLITE_{pragma.upper()}' in os.environ}
@@ -0,0 +1,90 @@
+import random
+
+from catalog import PRICE_PREFIX_STEP, CatalogIndex
+
+PRODUCTS = [
+    {'id': 7, 'name': 'rose', 'type': 'flower', 'price': 100, 'discount_check': 1, 'pic': None},
+    {'id': 2, 'name': 'tulip', 'type': 'flower', 'price': 50, 'discount_check': 0, 'pic': None},
+    {'id': 4, 'name': 'vase', 'type': 'decor', 'price': 300, 'discount_check': 1, 'pic': None},
+    {'id': 9, 'name': 'lily', 'type': 'flower', 'price': 150, 'discount_check': 0, 'pic': None},
+    {'id': 12, 'name': 'peony', 'type': 'flower', 'price': 100, 'discount_check': 1, 'pic': None},
+    {'id': 15, 'name': 'card', 'type': 'decor', 'price': None, 'discount_check': 0, 'pic': None},
+]
+
+
+def ids(products):
+    return [product['id'] for product in products]
+
+
+def brute_force(type_=None, price_min=None, price_max=None, discount=None, after_id=0, products=PRODUCTS):
+    result = []
+    for product in sorted(products, key=lambda product: product['id']):
+        if product['id'] <= after_id or type_ is not None and product['type'] != type_:
+            continue
+        if discount is not None and bool(product['discount_check']) != discount:
+            continue
+        if price_min is not None or price_max is not None:
+            if product['price'] is None:
+                continue
+            if price_min is not None and product['price'] < price_min:
+                continue
+            if price_max is not None and product['price'] > price_max:
+                continue
+        result.append(product['id'])
+    return result
+
+
+def test_page_after_id():
+    index = CatalogIndex(PRODUCTS)
+    assert ids(index.page()) == [2, 4, 7, 9, 12, 15]
+    assert ids(index.page(after_id=4, limit=2)) == [7, 9]
+    assert ids(index.page(after_id=5)) == [7, 9, 12, 15]
+    assert index.page(after_id=15) == []
+
+
+def test_query_filters_with_after_id():
+    index = CatalogIndex(PRODUCTS)
+    assert ids(index.query(type_='flower', after_id=7)) == [9, 12]
+    assert ids(index.query(discount=True, after_id=4)) == [7, 12]
+    assert ids(index.query(discount=False, after_id=2)) == [9, 15]
+    assert ids(index.query(price_min=100, price_max=150, after_id=8)) == [9, 12]
+    assert ids(index.query(type_='flower', price_max=100, discount=True, after_id=7)) == [12]
+    assert index.query(type_='decor', after_id=15) == []
+    assert index.query(type_='tree') == []
+
+
+def test_query_pages_follow_each_other():
+    index = CatalogIndex(PRODUCTS)
+    pages, after_id = [], 0
+    while True:
+        page = index.query(type_='flower', price_min=60, after_id=after_id, limit=1)
+        if not page:
+            break
+        pages.append(page[0]['id'])
+        after_id = page[-1]['id']
+    assert pages == [7, 9, 12]
+
+
+def test_query_matches_brute_force():
+    index = CatalogIndex(PRODUCTS)
+    for type_ in (None, 'flower', 'decor'):
+        for discount in (None, True, False):
+            for price_min, price_max in ((None, None), (100, None), (None, 100), (60, 200)):
+                for after_id in (0, 2, 5, 9, 15):
+                    expected = brute_force(type_, price_min, price_max, discount, after_id)
+                    assert ids(index.query(type_, price_min, price_max, discount, after_id)) == expected
+
+
+def test_price_ranges_of_a_big_catalog():
+    generator = random.Random(1)
+    products = [{'id': id_, 'name': f'p{id_}', 'type': generator.choice(['flower', 'decor']),
+                 'price': None if id_ % 97 == 0 else generator.randint(1, 1000),
+                 'discount_check': generator.random() < 0.3, 'pic': None}
+                for id_ in generator.sample(range(1, 20000), 3000)]
+    index = CatalogIndex(products)
+    assert len(index.price_prefixes) == len(index.prices) // PRICE_PREFIX_STEP + 1
+    for price_min, price_max in ((None, None), (100, 900), (500, 500), (None, 1), (1000, None), (900, 100),
+                                 (index.prices[PRICE_PREFIX_STEP], index.prices[2 * PRICE_PREFIX_STEP])):
+        for type_, discount, after_id in ((None, None, 0), ('flower', True, 5000), ('decor', False, 15000)):
+            expected = brute_force(type_, price_min, price_max, discount, after_id, products)
+            assert ids(index.query(type_, price_min, price_max, discount, after_id)) == expected
@@ -0,0 +1,83 @@
+import sqlite3
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from db_connection import DataBase, Writer, WriterTimeout, connect
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'test.db')
+    connection = sqlite3.connect(path)
+    connection.execute('create table item (name text unique)')
+    connection.commit()
+    connection.close()
+    return path
+
+
+def names(path):
+    connection = sqlite3.connect(path)
+    try:
+        return sorted(row[0] for row in connection.execute('select name from item'))
+    finally:
+        connection.close()
+
+
+def insert(name):
+    return lambda connection: connection.execute('insert into item values (?)', (name,)).rowcount
+
+
+def test_failed_write_does_not_roll_back_others(database):
+    writer = Writer(database, pragmas={})
+    connection = connect(database, {}, isolation_level=None)
+    jobs = [(insert('a'), Future()), (insert('a'), Future()), (insert('b'), Future())]
+    try:
+        writer._commit(connection, jobs)
+    finally:
+        connection.close()
+    assert jobs[0][1].result() == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        jobs[1][1].result()
+    assert jobs[2][1].result() == 1
+    assert names(database) == ['a', 'b']
+
+
+def test_writes_are_committed_through_the_thread(database):
+    writer = Writer(database, pragmas={}, window=0.05)
+    try:
+        futures = [writer.submit(insert(name)) for name in ('a', 'b', 'b', 'c')]
+        results = [future.exception(5) or future.result() for future in futures]
+    finally:
+        writer.stop()
+    assert results[:2] == [1, 1] and results[3] == 1
+    assert isinstance(results[2], sqlite3.IntegrityError)
+    assert names(database) == ['a', 'b', 'c']
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_writer_restarts_after_connect_failure(tmp_path, database):
+    writer = Writer(str(tmp_path / 'missing' / 'test.db'), pragmas={}, timeout=5)
+    with pytest.raises(sqlite3.OperationalError):
+        DataBase(writer=writer)._write(insert('a'))
+    # queued writes are failed after the thread is forgotten
+    assert writer._thread is None
+    writer.database = database
+    try:
+        assert DataBase(writer=writer)._write(insert('a')) == 1
+    finally:
+        writer.stop()
+    assert names(database) == ['a']
+
+
+def test_write_times_out(database):
+    writer = Writer(database, pragmas={}, timeout=0.1)
+    blocked = writer.submit(lambda connection: time.sleep(0.5))
+    try:
+        with pytest.raises(WriterTimeout):
+            DataBase(writer=writer)._write(insert('a'))
+        blocked.result(5)
+    finally:
+        writer.stop()
+    assert names(database) == []
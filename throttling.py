@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+
+LOGIN_FAILURES_LIMIT = 5  # wrong passwords for one telephone or login in the window, then it is locked
+LOGIN_FAILURES_WINDOW = 900  # seconds
+IP_ATTEMPTS_LIMIT = 30  # login attempts from one ip address in the window
+IP_ATTEMPTS_WINDOW = 60  # seconds
+
+
+class RateLimiter:
+    """
+    Sliding window counter of events by key, thread safe
+    counts are kept in two fixed windows, the current and the previous one,
+    the previous window is weighted by its part still inside the sliding window
+    when a new window starts, older counts are dropped at once with their dict
+    """
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._index = 0
+        self._current = {}
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def _rotate(self, now: float):
+        """
+        move to the window of the given time
+        :param now: time in seconds
+        :return: part of the current window that has passed, from 0 to 1
+        """
+        index, passed = divmod(now, self.window)
+        index = int(index)
+        if index != self._index:
+            self._previous = self._current if index == self._index + 1 else {}
+            self._current = {}
+            self._index = index
+        return passed / self.window
+
+    def _count(self, key, passed: float):
+        """
+        number of events of the key in the sliding window
+        :return: float
+        """
+        return self._previous.get(key, 0) * (1 - passed) + self._current.get(key, 0)
+
+    def hit(self, key):
+        """
+        count an event of the key if it is under the limit
+        :param key: for example ip address or login
+        :return: bool, False if the limit is reached and the event is not counted
+        """
+        with self._lock:
+            passed = self._rotate(time.time())
+            if self._count(key, passed) >= self.limit:
+                return False
+            self._current[key] = self._current.get(key, 0) + 1
+            return True
+
+    def undo(self, key):
+        """
+        take back one event counted by hit(), when the attempt ended before it could be judged
+        :param key: for example ip address or login
+        :return: None
+        """
+        with self._lock:
+            self._rotate(time.time())
+            # the event moves to the previous window if a new one has started since hit()
+            for counts in (self._current, self._previous):
+                if counts.get(key, 0) > 0:
+                    counts[key] -= 1
+                    if not counts[key]:
+                        del counts[key]
+                    return
+
+    def reset(self, key):
+        """
+        forget events of the key
+        :param key: for example ip address or login
+        :return: None
+        """
+        with self._lock:
+            self._current.pop(key, None)
+            self._previous.pop(key, None)
+
+    def retry_after(self):
+        """
+        seconds to the start of the next window, when the oldest counts start to expire
+        :return: int
+        """
+        return max(1, math.ceil(self.window - time.time() % self.window))
+
+
+LOGIN_FAILURES = RateLimiter(LOGIN_FAILURES_LIMIT, LOGIN_FAILURES_WINDOW)
+IP_ATTEMPTS = RateLimiter(IP_ATTEMPTS_LIMIT, IP_ATTEMPTS_WINDOW)
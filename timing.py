@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from fastapi.responses import JSONResponse as BaseJSONResponse
+from starlette.datastructures import MutableHeaders
+
+# a child of the logger uvicorn configures, so the lines are printed by its handler at INFO,
+# with --log-level warning they are dropped
+logger = logging.getLogger('uvicorn.error.timing')
+
+
+class Timings:
+    """
+    Durations of spans of one request, summed by span name
+    thread safe, spans are reported from the event loop and from executor threads
+    """
+    def __init__(self):
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, duration: float):
+        """
+        add duration to the span
+        :param name: name of the span, for example db
+        :param duration: seconds
+        :return: None
+        """
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def header(self, total: float):
+        """
+        value of Server-Timing header, durations in milliseconds
+        :param total: seconds of the whole request
+        :return: str, for example "db;dur=1.20, session;dur=0.35, total;dur=4.10"
+        """
+        with self._lock:
+            spans = list(self.spans.items())
+        return ', '.join(f'{name};dur={duration * 1000:.2f}' for name, duration in spans + [('total', total)])
+
+
+_current = ContextVar('timings', default=None)
+
+
+@contextmanager
+def span(name: str):
+    """
+    measure a block of code as a span of the current request,
+    does nothing outside of a request, spans may be nested or overlap (session includes its db)
+    :param name: name of the span, for example db
+    :return: context manager
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """
+    decorator to measure every call of a function as a span
+    :param name: name of the span
+    :return: decorator
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class JSONResponse(BaseJSONResponse):
+    """
+    JSONResponse that reports serialization of its content as the render span
+    """
+    def render(self, content) -> bytes:
+        with span('render'):
+            return super().render(content)
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware collecting spans of every http request,
+    adds Server-Timing header to the response and logs one line with the durations
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = Timings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', timings.header(time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - start
+            logger.info('method=%s path=%s status=%s total=%.2fms %s', scope['method'], scope['path'],
+                        status_code, total * 1000,
+                        ' '.join(f'{name}={duration * 1000:.2f}ms' for name, duration in timings.spans.items()))
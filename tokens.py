@@ -0,0 +1,81 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+
+import settings
+
+
+def secret(mode: str, key: str):
+    """
+    key to sign tokens
+    signed sessions need SESSION_SECRET: a random key of every process would not survive a restart
+    and would not be shared between workers, so users would be logged out at random
+    :param mode: SESSION_MODE
+    :param key: SESSION_SECRET
+    :return: bytes, a random key if tokens are not used for sessions
+    """
+    if key:
+        return key.encode('utf-8')
+    if mode == 'signed':
+        raise ValueError('SESSION_SECRET is required with SESSION_MODE=signed')
+    return secrets.token_bytes(32)
+
+
+SECRET = secret(settings.SESSION_MODE, settings.SESSION_SECRET)
+
+
+def _encode(data: bytes):
+    """
+    urlsafe base64 without padding
+    :param data: bytes to encode
+    :return: str
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(data: str):
+    """
+    decode urlsafe base64 without padding
+    :param data: str to decode
+    :return: bytes
+    """
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _signature(payload: str):
+    """
+    hmac sha256 signature of the payload
+    :param payload: encoded payload
+    :return: str
+    """
+    return _encode(hmac.new(SECRET, payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def sign(data: dict):
+    """
+    make signed token in format payload.signature
+    :param data: json serializable dict to put in the token
+    :return: str token
+    """
+    payload = _encode(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    return f'{payload}.{_signature(payload)}'
+
+
+def unsign(token: str):
+    """
+    check token signature and get its data
+    :param token: token made by sign()
+    :return: dict, None if the token is malformed or the signature is wrong
+    """
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature.encode('ascii'), _signature(payload).encode('ascii')):
+            return None
+        data = json.loads(_decode(payload))
+    except (AttributeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import tempfile
+from typing import NamedTuple
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+UPLOAD_CHUNK_SIZE = 64 * 1024  # bytes gathered before one write to disk
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # bytes of a multipart body besides the file: boundaries, headers, fields
+UPLOAD_LIMITS = {'banner': 5 * 1024 * 1024,  # max size of an uploaded image in bytes by item
+                 'product': 2 * 1024 * 1024}
+
+
+class UploadTooLarge(Exception):
+    """
+    uploaded file or the whole body is bigger than the limit of its item
+    """
+
+
+class BadUpload(Exception):
+    """
+    request body is not a multipart form
+    """
+
+
+class Upload(NamedTuple):
+    """
+    file received from a multipart form, kept in a temporary file until store()
+    """
+    file_name: str  # name sent by the client, see safe_name
+    temp_path: str
+    size: int
+    sha256: str
+
+
+def safe_name(file_name: str):
+    """
+    name of an uploaded file without directories, spaces are replaced with "-"
+    :param file_name: name sent by the client
+    :return: str, None if there is no usable name or it has control characters (NUL is not allowed in paths)
+    """
+    name = os.path.basename((file_name or '').replace('\\', '/')).replace(' ', '-')
+    if name in ('', '.', '..') or any(ord(char) < 32 or ord(char) == 127 for char in name):
+        return None
+    return name
+
+
+def _decode(value: bytes):
+    """
+    decode a header value of a form part, utf-8 or latin-1 as browsers send them
+    :param value: raw value
+    :return: str
+    """
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+class _TempFile:
+    """
+    temporary file in the target directory, written by chunks in a threadpool,
+    counting size and sha256 on the way
+    """
+    def __init__(self, directory: str, limit: int):
+        self.directory = directory
+        self.limit = limit
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.buffer = bytearray()
+
+    def _open(self):
+        fd, self.path = tempfile.mkstemp(prefix='.upload-', dir=self.directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    async def open(self):
+        await run_in_threadpool(self._open)
+
+    async def write(self, data: bytes):
+        """
+        add data to the file, it is written to disk by UPLOAD_CHUNK_SIZE
+        :param data: bytes of the file
+        :return: None
+        """
+        self.size += len(data)
+        if self.size > self.limit:
+            raise UploadTooLarge(self.path)
+        self.digest.update(data)
+        self.buffer += data
+        if len(self.buffer) >= UPLOAD_CHUNK_SIZE:
+            await self.flush()
+
+    async def flush(self):
+        chunk, self.buffer = bytes(self.buffer), bytearray()
+        await run_in_threadpool(self.file.write, chunk)
+
+    async def close(self):
+        await self.flush()
+        await run_in_threadpool(self.file.close)
+
+    def discard(self):
+        """
+        close and remove the file, blocking but short
+        :return: None
+        """
+        if self.file is not None:
+            self.file.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class _Parts:
+    """
+    callbacks of MultipartParser, parts of the body are collected as messages
+    ('headers', {name: value}), ('data', bytes) and ('end', b'') to be handled after each write
+    """
+    def __init__(self):
+        self.messages = []
+        self.headers = {}
+        self.name = b''
+        self.value = b''
+
+    def callbacks(self):
+        return {'on_part_begin': self.on_part_begin,
+                'on_header_field': self.on_header_field,
+                'on_header_value': self.on_header_value,
+                'on_header_end': self.on_header_end,
+                'on_headers_finished': self.on_headers_finished,
+                'on_part_data': self.on_part_data,
+                'on_part_end': self.on_part_end}
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.name.lower()] = self.value
+        self.name = self.value = b''
+
+    def on_headers_finished(self):
+        self.messages.append(('headers', self.headers))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self.messages.append(('data', data[start:end]))
+
+    def on_part_end(self):
+        self.messages.append(('end', b''))
+
+
+async def receive(stream, content_type: str, field: str, directory: str, limit: int):
+    """
+    parse a multipart body while it comes and write the file of the field to a temporary file
+    in the directory, the body is never buffered or spooled in memory as a whole,
+    other fields of the form are skipped
+    :param stream: async iterator of body chunks, request.stream()
+    :param content_type: Content-Type header of the request, with the boundary
+    :param field: name of the form field with the file
+    :param directory: directory of the file, the temporary file is created there to be renamed by store()
+    :param limit: max size of the file in bytes, UploadTooLarge is raised as soon as the file
+                  or the whole body (limit + UPLOAD_FORM_OVERHEAD) gets bigger
+    :return: Upload, None if there is no file in the field
+    """
+    media_type, options = parse_options_header(content_type or '')
+    if media_type != b'multipart/form-data' or not options.get(b'boundary'):
+        raise BadUpload(content_type)
+    parts = _Parts()
+    parser = MultipartParser(options[b'boundary'], parts.callbacks())
+    received = 0
+    file = None  # the temporary file while its part is being received
+    result = None
+    try:
+        async for chunk in stream:
+            received += len(chunk)
+            if received > limit + UPLOAD_FORM_OVERHEAD:
+                raise UploadTooLarge(field)
+            try:
+                parser.write(chunk)
+            except ValueError as e:
+                raise BadUpload(str(e)) from e
+            for kind, value in parts.messages:
+                if kind == 'headers':
+                    disposition, params = parse_options_header(value.get(b'content-disposition', b''))
+                    if (result is None and _decode(params.get(b'name', b'')) == field
+                            and b'filename' in params):
+                        file = _TempFile(directory, limit)
+                        await file.open()
+                        file_name = _decode(params[b'filename'])
+                elif kind == 'data' and file is not None:
+                    await file.write(value)
+                elif kind == 'end' and file is not None:
+                    await file.close()
+                    result = Upload(file_name, file.path, file.size, file.digest.hexdigest())
+                    file = None
+            parts.messages.clear()
+        if file is not None:
+            raise BadUpload('the body ends inside the file')
+    except BaseException:
+        if file is not None:
+            file.discard()
+        if result is not None:
+            os.unlink(result.temp_path)
+        raise
+    return result
+
+
+def store(upload: Upload, path: str):
+    """
+    move received file to its path, replacing the existing file,
+    a partly written file is never visible under the path
+    blocking, should be called in a threadpool
+    :param upload: Upload made by receive()
+    :param path: destination path, in the directory given to receive()
+    :return: None
+    """
+    try:
+        os.chmod(upload.temp_path, 0o644)
+        os.replace(upload.temp_path, path)
+    except (OSError, ValueError):
+        # ValueError is raised for a path with NUL
+        os.unlink(upload.temp_path)
+        raise
+
+
+def discard(upload: Upload):
+    """
+    remove received file that is not stored
+    :param upload: Upload made by receive()
+    :return: None
+    """
+    os.unlink(upload.temp_path)